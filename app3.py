@@ -1,77 +1,192 @@
 import os,time
-import requests
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import orjson
 from log import logger
-from flask import Flask, render_template, request, redirect, url_for, flash
-from database import init_db, add_vm_record, update_vm_status, delete_vm_record, get_all_vm_records, get_vm_record
+from quart import Quart, render_template, request, redirect, url_for, flash
+from database import (
+    init_db, add_vm_record, update_vm_status, delete_vm_record, iter_vm_records,
+    update_vm_status_if_changed, bulk_sync_vm_records,
+)
 
 # 定义 Libvirt Server 的基础 URL
 LIBVIRT_API_BASE_URL = "http://127.0.0.1:5001/api/v1" # 根据 libvirt_server.py 实际运行的地址和端口调整
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.secret_key = 'your_super_secret_key' # Replace with a strong key for flash messages
 
-# Load configuration from config.py into Flask app's config object
+# Load configuration from config.py into Quart app's config object
 app.config.from_object('config')
 
 # Initialize database and Libvirt manager
 init_db()
 
+# 所有到 Libvirt Server 的请求共享同一个 keep-alive 连接池
+# 连接池上限为 20，建立连接失败时自动重试 2 次
+client = httpx.AsyncClient(
+    base_url=LIBVIRT_API_BASE_URL,
+    timeout=5,
+    transport=httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+        retries=2,
+    ),
+)
+
+# SQLite 写操作可能因 fsync / busy_timeout 阻塞，放到有上限的线程池中执行，避免阻塞事件循环
+db_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='db')
+
+async def run_db(func, *args):
+    """Runs a blocking database helper in db_executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, func, *args)
+
+@app.after_serving
+async def close_client():
+    await client.aclose()
+    db_executor.shutdown(wait=True)
+
+class StatusCache:
+    """
+    In-process TTL cache for data fetched from the Libvirt Server.
+    Burst page reloads are served from memory instead of hitting libvirtd each time.
+    """
+    def __init__(self, ttl=3.0):
+        self.ttl = ttl
+        self._entries = {} # key -> (expiry_monotonic, value)
+        self._lock = threading.Lock()
+
+    async def get_or_refresh(self, key, loader, ttl=None):
+        """Returns the cached value for key, awaiting loader() to refresh it once expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+
+        # loader 抛出的异常直接向上传递，失败的结果不会被缓存
+        value = await loader()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drops one entry, or the whole cache when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+status_cache = StatusCache(ttl=3.0)
+
+async def fetch_libvirt_vms_map():
+    """Fetches all VMs from the Libvirt Server, keyed by VM name."""
+    # 列表页只需要状态和链接，不需要 VNC 端口/磁盘路径等详细信息
+    response = await client.get("/vms", params={"detailed": "false"})
+    response.raise_for_status() # 对 4xx/5xx 响应抛出异常
+    libvirt_vms_data = orjson.loads(response.content).get('vms', [])
+    return {vm['name']: vm for vm in libvirt_vms_data}
+
+def _error_detail(e):
+    """Extracts the 'detail' field from an error response of the Libvirt Server."""
+    try:
+        return orjson.loads(e.response.content).get('detail', str(e))
+    except ValueError:
+        return str(e)
+
+async def wait_for_shutdown(vm_name, delays=(0.1, 0.2, 0.4, 0.8, 1.6, 3.0)):
+    """
+    Polls the Libvirt Server with exponential backoff until the VM reports 'Shut Off'.
+    Returns the last observed status, or None if the VM could not be queried.
+    """
+    vm_status = None
+    for delay in delays:
+        try:
+            response = await client.get(f"/vms/{vm_name}")
+            response.raise_for_status()
+            vm_status = orjson.loads(response.content).get('status')
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to poll status of VM '{vm_name}': {e}")
+            return None
+        if vm_status == 'Shut Off':
+            break
+        await asyncio.sleep(delay)
+    return vm_status
+
+async def finalize_stop(vm_name):
+    """Waits in the background for a stopping VM to shut off and records its final status."""
+    vm_status = await wait_for_shutdown(vm_name)
+    if vm_status:
+        await run_db(update_vm_status_if_changed, vm_name, vm_status)
+        status_cache.invalidate()
+
 @app.route('/')
-def index():
+async def index():
     """Displays all virtual machine lists."""
-    vms_from_db = get_all_vm_records() # 从你的数据库获取数据
-
     # 从 Libvirt Server 获取最新状态
     try:
-        response = requests.get(f"{LIBVIRT_API_BASE_URL}/vms")
-        response.raise_for_status() # 对 4xx/5xx 响应抛出异常
-        libvirt_vms_data = response.json().get('vms', [])
-        libvirt_vms_map = {vm['name']: vm for vm in libvirt_vms_data}
-    except requests.exceptions.RequestException as e:
-        flash(f"Error connecting to Libvirt backend: {e}. VM statuses might be outdated.", 'error')
+        libvirt_vms_map = await status_cache.get_or_refresh('vms', fetch_libvirt_vms_map)
+    except httpx.HTTPError as e:
+        await flash(f"Error connecting to Libvirt backend: {e}. VM statuses might be outdated.", 'error')
         libvirt_vms_map = {} # 如果连接失败，则没有最新的 Libvirt 状态
 
     # 更新数据库中的状态以同步
-    updated_vms_count = 0
+    # 先收集需要更新/删除的记录，最后在一个事务中批量提交
+    to_update = []
+    to_update_links = []
+    to_delete = []
     final_vms_for_display = []
+    db_pairs = set() # 数据库中的 (name, status)
 
-    for vm_record in vms_from_db:
-        vm_name_db = vm_record[0]
+    # 从你的数据库逐行读取，边读边构建显示列表，不再先 fetchall 出一份完整副本
+    for vm_record in iter_vm_records():
+        vm_name_db = vm_record['name']
+        db_pairs.add((vm_name_db, vm_record['status']))
         # 尝试从 Libvirt Server 的响应中获取最新状态
         libvirt_vm_info = libvirt_vms_map.get(vm_name_db)
 
         if libvirt_vm_info:
+            vm = dict(vm_record)
             current_status_libvirt = libvirt_vm_info['status']
-            # 如果数据库状态与 Libvirt 实际状态不一致，则更新
-            if current_status_libvirt != vm_record[2]:
-                update_vm_status(vm_name_db, current_status_libvirt)
-                updated_vms_count += 1
+            # 状态是否变化由数据库的 UPDATE ... WHERE status <> ? 判断
+            to_update.append((current_status_libvirt, vm_name_db))
+            vm['status'] = current_status_libvirt
+            # Guacamole 访问链接在后端异步创建，就绪后同步到数据库
+            if not vm['link'] and libvirt_vm_info.get('link'):
+                vm['link'], vm['connid'] = libvirt_vm_info['link'], libvirt_vm_info.get('connid')
+                to_update_links.append((vm['link'], vm['connid'], vm_name_db))
             # 将最新的 Libvirt 状态信息用于显示
-            final_vms_for_display.append(libvirt_vm_info)
+            final_vms_for_display.append(vm)
         else:
             # 如果 Libvirt Server 报告该 VM 不存在，则从数据库中删除
             # 或者如果 Libvirt Server 没响应，则保留数据库现有状态
             # 这里选择删除（如果确定Libvirt是权威数据源）
-            delete_vm_record(vm_name_db)
-            flash(f"Virtual machine '{vm_name_db}' not found in Libvirt, removed from database.", 'warning')
-            updated_vms_count += 1
-            
+            to_delete.append(vm_name_db)
+            await flash(f"Virtual machine '{vm_name_db}' not found in Libvirt, removed from database.", 'warning')
+
+    # 稳态下数据库与 Libvirt 完全一致（这是最常见的情况），跳过所有写操作
+    live_pairs = {(name, status) for status, name in to_update}
+    in_sync = db_pairs == live_pairs and not to_update_links
+
+    updated_vms_count = 0
+    if not in_sync:
+        updated_vms_count = await run_db(bulk_sync_vm_records, to_update, to_update_links, to_delete)
     if updated_vms_count > 0:
         logger.info(f"Refreshed status for {updated_vms_count} VMs in the database.")
 
-    # 重新从数据库获取最终列表，确保显示最新数据
-    # 或者直接使用 final_vms_for_display (需要确保它包含所有你想显示的VMs)
-    final_vms = get_all_vm_records() # 假设这里会反映上面的更新
-    return render_template('index.html', vms=final_vms)
+    # final_vms_for_display 已经反映了上面的更新，且保持了 creation_time 倒序，无需再次查询数据库
+    return await render_template('index.html', vms=final_vms_for_display)
 
 
 @app.route('/create_vm', methods=['GET', 'POST'])
-def create_vm_page():
+async def create_vm_page():
     if request.method == 'POST':
-        vm_name = request.form['vm_name']
-        vm_pwd = request.form['vm_pwd']
-        memory_mb = int(request.form['memory_mb'])
-        vcpu_count = int(request.form['vcpu_count'])
+        form = await request.form
+        vm_name = form['vm_name']
+        vm_pwd = form['vm_pwd']
+        memory_mb = int(form['memory_mb'])
+        vcpu_count = int(form['vcpu_count'])
 
         payload = {
             "vm_name": vm_name,
@@ -82,107 +197,105 @@ def create_vm_page():
 
         try:
             # 调用 Libvirt Server 的创建 VM API
-            response = requests.post(f"{LIBVIRT_API_BASE_URL}/vms", json=payload)
+            response = await client.post("/vms", json=payload)
             response.raise_for_status() # 如果状态码不是 2xx，则抛出异常
 
-            result_data = response.json()
+            result_data = orjson.loads(response.content)
             message = result_data.get('message', 'Unknown message')
             success = result_data.get('success', False)
             extra_data = result_data.get('data', {})
 
             if success:
+                status_cache.invalidate()
                 vnc_port = extra_data.get('vncport')
-                link = extra_data.get('link')
+                # Guacamole 链接由后端在后台创建，index 刷新时再同步 link/connid
+                link = extra_data.get('link') or ''
                 connid = extra_data.get('connid')
                 # 添加到你自己的数据库
-                add_vm_record(vm_name, os.path.basename(app.config['BASE_IMAGE_PATH']), 
+                await run_db(add_vm_record, vm_name, os.path.basename(app.config['BASE_IMAGE_PATH']), 
                             '运行中', vnc_port, link, connid, memory_mb, vcpu_count)
 
-                flash_message = f"Virtual machine '{vm_name}' created and started successfully! URL: {vnc_port}."
-                flash(flash_message, 'success')
+                flash_message = f"Virtual machine '{vm_name}' created and started successfully! VNC port: {vnc_port}, remote access link is being provisioned."
+                await flash(flash_message, 'success')
                 return redirect(url_for('index'))
             else:
-                flash(f"Failed to create virtual machine: {message}", 'error')
+                await flash(f"Failed to create virtual machine: {message}", 'error')
 
-        except requests.exceptions.ConnectionError:
-            flash("Failed to connect to Libvirt backend server. Please ensure it's running on 127.0.0.1:5001.", 'error')
-        except requests.exceptions.HTTPError as e:
-            error_detail = e.response.json().get('detail', str(e)) if e.response else str(e)
-            flash(f"Libvirt server responded with an error: {error_detail}", 'error')
-        except requests.exceptions.RequestException as e:
-            flash(f"An unexpected error occurred during API call: {e}", 'error')
+        except httpx.ConnectError:
+            await flash("Failed to connect to Libvirt backend server. Please ensure it's running on 127.0.0.1:5001.", 'error')
+        except httpx.HTTPStatusError as e:
+            await flash(f"Libvirt server responded with an error: {_error_detail(e)}", 'error')
+        except httpx.HTTPError as e:
+            await flash(f"An unexpected error occurred during API call: {e}", 'error')
 
-    return render_template('create_vm.html')
+    return await render_template('create_vm.html')
 
 @app.route('/manage_vm/<vm_name>', methods=['POST'])
-def manage_vm_action(vm_name):
-    action = request.form.get('action')
+async def manage_vm_action(vm_name):
+    form = await request.form
+    action = form.get('action')
     endpoint_map = {
-        'start': f"{LIBVIRT_API_BASE_URL}/vms/{vm_name}/start",
-        'stop': f"{LIBVIRT_API_BASE_URL}/vms/{vm_name}/stop",
-        'destroy': f"{LIBVIRT_API_BASE_URL}/vms/{vm_name}/destroy",
-        'delete': f"{LIBVIRT_API_BASE_URL}/vms", # DELETE 方法
+        'start': f"/vms/{vm_name}/start",
+        'stop': f"/vms/{vm_name}/stop",
+        'destroy': f"/vms/{vm_name}/destroy",
+        'delete': "/vms", # DELETE 方法
     }
     
-    # 动态确定 HTTP 方法
     api_url = endpoint_map.get(action)
-    http_method = requests.post
-    if action == 'delete':
-        http_method = requests.delete
-        connid = int(request.form.get('connid'))
-        payload = {
-            "vm_name": vm_name,
-            "connid": connid
-        }
-
-    
     if not api_url:
-        flash("Invalid operation.", 'error')
+        await flash("Invalid operation.", 'error')
         return redirect(url_for('index'))
 
     try:
         if action == 'delete':
-            response = http_method(api_url, json=payload)
+            # httpx 的 delete() 不接受请求体，这里使用通用的 request()
+            connid = form.get('connid', '')
+            payload = {
+                "vm_name": vm_name,
+                "connid": int(connid) if connid.isdigit() else None
+            }
+            response = await client.request("DELETE", api_url, json=payload)
         else:
-            response = http_method(api_url)
+            response = await client.post(api_url)
         response.raise_for_status()
         
-        result_data = response.json()
+        result_data = orjson.loads(response.content)
         message = result_data.get('message', 'Unknown message')
         success = result_data.get('success', False)
 
         if success:
-            flash(message, 'success')
+            # 使缓存失效，保证状态变化在下一次刷新时立即可见
+            status_cache.invalidate()
+            await flash(message, 'success')
             # 根据操作更新本地数据库状态，或者在下次刷新时由 index 路由同步
             if action == 'start':
-                update_vm_status(vm_name, '运行中')
+                await run_db(update_vm_status, vm_name, '运行中')
             elif action == 'stop':
-                update_vm_status(vm_name, '正在关机')
+                await run_db(update_vm_status, vm_name, '正在关机')
             elif action == 'destroy':
-                update_vm_status(vm_name, '已关机')
+                await run_db(update_vm_status, vm_name, '已关机')
             elif action == 'delete':
-                delete_vm_record(vm_name) # 从数据库中移除
+                await run_db(delete_vm_record, vm_name) # 从数据库中移除
             
-            # 对于 stop 操作，可能需要等待一小段时间再刷新状态
+            # 对于 stop 操作，在后台等待虚拟机真正关机（或超时）后再刷新状态，请求立即返回
             if action == 'stop':
-                time.sleep(2) 
+                app.add_background_task(finalize_stop, vm_name)
 
         else:
-            flash(f"Failed to perform action '{action}' for VM '{vm_name}': {message}", 'error')
+            await flash(f"Failed to perform action '{action}' for VM '{vm_name}': {message}", 'error')
 
-    except requests.exceptions.ConnectionError:
-        flash("Failed to connect to Libvirt backend server. Please ensure it's running.", 'error')
-    except requests.exceptions.HTTPError as e:
-        error_detail = e.response.json().get('detail', str(e)) if e.response else str(e)
-        flash(f"Libvirt server responded with an error: {error_detail}", 'error')
-    except requests.exceptions.RequestException as e:
-        flash(f"An unexpected error occurred during API call: {e}", 'error')
+    except httpx.ConnectError:
+        await flash("Failed to connect to Libvirt backend server. Please ensure it's running.", 'error')
+    except httpx.HTTPStatusError as e:
+        await flash(f"Libvirt server responded with an error: {_error_detail(e)}", 'error')
+    except httpx.HTTPError as e:
+        await flash(f"An unexpected error occurred during API call: {e}", 'error')
 
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
     # The LibvirtManager's __init__ method now handles all environment checks and connection.
     # We simply check if the connection was successful after initialization.
-    logger.info("Starting Flask application.")
+    logger.info("Starting Quart application.")
     
     app.run(debug=False, host='0.0.0.0', port=5002)
\ No newline at end of file
@@ -1,28 +1,73 @@
 import os
+import atexit
 import sqlite3
+import threading
+from contextlib import contextmanager
 # 数据库文件路径
 DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vm_manager.db')
 
+# 每个线程持有一个长连接，避免每次调用都重新 connect
+_local = threading.local()
+
+# SQL 语句定义为模块级常量，配合长连接命中 sqlite3 的预编译语句缓存
+_SQL_CREATE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS vms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        connid INTEGER,
+        name TEXT NOT NULL UNIQUE,
+        template_name TEXT NOT NULL,
+        status TEXT NOT NULL,
+        link TEXT NOT NULL,
+        creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+        vnc_port INTEGER,
+        memorysize INTEGER,
+        vcpucount INTEGER
+    )
+'''
+_SQL_CREATE_INDEX_CREATION_TIME = "CREATE INDEX IF NOT EXISTS idx_vms_creation_time ON vms(creation_time DESC)"
+# RETURNING 需要 SQLite 3.35+，省去插入后再 SELECT 一次
+_SQL_INSERT = "INSERT INTO vms (name, template_name, status, vnc_port, link, connid, memorysize, vcpucount) VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id, creation_time"
+_SQL_UPDATE_STATUS = "UPDATE vms SET status = ? WHERE name = ?"
+# 由数据库比较新旧状态，状态未变化时不产生写入
+_SQL_UPDATE_STATUS_IF_CHANGED = "UPDATE vms SET status = ?1 WHERE name = ?2 AND status <> ?1"
+_SQL_UPDATE_LINK = "UPDATE vms SET link = ?, connid = ? WHERE name = ?"
+_SQL_DELETE = "DELETE FROM vms WHERE name = ?"
+_SQL_SELECT_ALL = "SELECT connid, name, template_name, status, creation_time, vnc_port, link, memorysize, vcpucount FROM vms ORDER BY creation_time DESC"
+_SQL_SELECT_ONE = "SELECT name, template_name, status, creation_time, vnc_port, link, connid, memorysize, vcpucount FROM vms WHERE name = ?"
+_SQL_SELECT_LINK_INFO = "SELECT status, vnc_port, link FROM vms WHERE name = ?"
+
+def _get_conn():
+    """获取当前线程的数据库连接（首次调用时创建并设置 WAL 等参数）"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        # 行对象既支持 row[0] 也支持 row["status"]，调用方不再依赖列的位置
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA busy_timeout=5000")
+        atexit.register(conn.close)
+        _local.conn = conn
+    return conn
+
+@contextmanager
+def _transaction():
+    """在当前线程的连接上开启一个事务，正常退出时提交、出现异常时回滚"""
+    conn = _get_conn()
+    conn.execute("BEGIN")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
 def init_db():
-    """初始化数据库，创建 VMs 表"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS vms (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            connid INTEGER,
-            name TEXT NOT NULL UNIQUE,
-            template_name TEXT NOT NULL,
-            status TEXT NOT NULL,
-            link TEXT NOT NULL,
-            creation_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-            vnc_port INTEGER,
-            memorysize INTEGER,
-            vcpucount INTEGER
-        )
-    ''')
-    conn.commit()
-    conn.close()
+    """初始化数据库，创建 VMs 表及索引"""
+    conn = _get_conn()
+    conn.execute(_SQL_CREATE_TABLE)
+    conn.execute(_SQL_CREATE_INDEX_CREATION_TIME)
 
 def add_vm_record(
         name, 
@@ -34,49 +79,56 @@ def add_vm_record(
         memorysize,
         vcpucount
 ):
-    """添加虚拟机记录"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO vms (name, template_name, status, vnc_port, link, connid, memorysize, vcpucount) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                   (name, template_name, status, vnc_port, link, connid, memorysize, vcpucount))
-    conn.commit()
-    conn.close()
+    """添加虚拟机记录，返回新记录的 (id, creation_time)"""
+    cursor = _get_conn().execute(_SQL_INSERT, (name, template_name, status, vnc_port, link, connid, memorysize, vcpucount))
+    return cursor.fetchone()
 
 def update_vm_status(name, status):
     """更新虚拟机状态"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE vms SET status = ? WHERE name = ?", (status, name))
-    conn.commit()
-    conn.close()
+    _get_conn().execute(_SQL_UPDATE_STATUS, (status, name))
+
+def update_vm_status_if_changed(name, status):
+    """仅当状态发生变化时更新虚拟机状态，返回受影响的行数"""
+    return _get_conn().execute(_SQL_UPDATE_STATUS_IF_CHANGED, (status, name)).rowcount
 
 def delete_vm_record(name):
     """删除虚拟机记录"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM vms WHERE name = ?", (name,))
-    conn.commit()
-    conn.close()
+    _get_conn().execute(_SQL_DELETE, (name,))
+
+def bulk_sync_vm_records(status_pairs, link_rows, names):
+    """在同一个事务中写入一次同步结果：状态 (status, name)、链接 (link, connid, name) 和要删除的名称
+    只提交一次，返回状态发生变化和被删除的行数之和"""
+    if not (status_pairs or link_rows or names):
+        return 0
+    changed = 0
+    with _transaction() as conn:
+        if status_pairs:
+            changed += conn.executemany(_SQL_UPDATE_STATUS_IF_CHANGED, status_pairs).rowcount
+        if link_rows:
+            conn.executemany(_SQL_UPDATE_LINK, link_rows)
+        if names:
+            changed += conn.executemany(_SQL_DELETE, [(name,) for name in names]).rowcount
+    return changed
 
 def get_all_vm_records():
     """获取所有虚拟机记录"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT connid, name, template_name, status, creation_time, vnc_port, link, memorysize, vcpucount FROM vms ORDER BY creation_time DESC")
-    vms = cursor.fetchall()
-    conn.close()
-    return vms
+    cursor = _get_conn().execute(_SQL_SELECT_ALL)
+    return cursor.fetchall()
+
+def iter_vm_records():
+    """逐行遍历所有虚拟机记录（按创建时间倒序），不会一次性把结果集加载到内存"""
+    yield from _get_conn().execute(_SQL_SELECT_ALL)
 
 def get_vm_record(name):
     """获取单个虚拟机记录"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, template_name, status, creation_time, vnc_port link, connid, memorysize, vcpucount FROM vms WHERE name = ?", (name,))
-    vm = cursor.fetchone()
-    conn.close()
-    return vm
+    cursor = _get_conn().execute(_SQL_SELECT_ONE, (name,))
+    return cursor.fetchone()
+
+def get_vm_link_info(name):
+    """获取虚拟机的远程访问信息 (status, vnc_port, link)"""
+    return _get_conn().execute(_SQL_SELECT_LINK_INFO, (name,)).fetchone()
 
 if __name__ == '__main__':
     # 首次运行时执行，或者手动运行一次以创建数据库
     init_db()
-    print(f"数据库已初始化: {DB_PATH}")
\ No newline at end of file
+    print(f"数据库已初始化: {DB_PATH}")
@@ -45,6 +45,7 @@ class Guacamole:
         default_datasource=None,
         cookies=False,
         verify=True,
+        session=None,
     ):
         if method.lower() not in ["https", "http"]:
             raise ValueError("Only http and https methods are valid.")
@@ -55,6 +56,8 @@ class Guacamole:
         self.password = password
         self.secret = secret
         self.verify = verify
+        # Reuse one pooled session so consecutive calls share keep-alive TLS connections
+        self.session = session if session is not None else requests.Session()
         resp = self.__authenticate()
         auth = resp.json()
         assert "authToken" in auth, "Failed to retrieve auth token"
@@ -80,7 +83,7 @@ class Guacamole:
         parameters = {"username": self.username, "password": self.password}
         if self.secret is not None:
             parameters["guac-totp"] = get_totp_token(self.secret)
-        r = requests.post(
+        r = self.session.post(
             url=self.REST_API + "/tokens",
             data=parameters,
             verify=self.verify,
@@ -100,7 +103,7 @@ class Guacamole:
                 method=method, url=url, params=params, payload=payload
             )
         )
-        r = requests.request(
+        r = self.session.request(
             method=method,
             url=url,
             params=params,
@@ -129,7 +132,7 @@ class Guacamole:
                 method=method, url=url, params=url_params, payload=payload
             )
         )
-        r = requests.request(
+        r = self.session.request(
             method=method,
             url=url,
             params=url_params,
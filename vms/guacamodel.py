@@ -1,7 +1,10 @@
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import base64
-import copy
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 from typing import Tuple, Optional, Dict, Union
 from log import logger
 
@@ -18,10 +21,18 @@ from templates import (
     ADD_READ_PERMISSION,
 )
 
+# Serialized request templates; decoding them yields a fresh mutable copy much faster than copy.deepcopy
+_USER_TMPL_JSON = orjson.dumps(USER)
+_VNC_TMPL_JSON = orjson.dumps(VNC_CONNECTION)
+
+# Client identifier suffix: NUL, type 'c' (connection), NUL, data source name
+_GUAC_SUFFIX = b'\x00c\x00postgresql'
+
 class GuacamoleClient:
     """
     Guacamole client class to manage connections and user permissions.
-    This class now supports the 'with' statement for resource management.
+    This class supports the 'with' statement for resource management, or can be
+    kept open for the lifetime of a process with open()/close().
     """
     GUAC_URL_PATH = "/"
     GUAC_METHOD = "https"
@@ -37,6 +48,9 @@ class GuacamoleClient:
         self.guac_password = guac_password
         self.guacamole: Optional[Guacamole] = None # Explicitly type as Optional
         self._is_initialized = False # Track if initialization was successful
+        self._lock = threading.Lock() # Serializes (re-)authentication
+        self.session: Optional[requests.Session] = None # Keep-alive HTTP session shared across re-authentication
+        self._executor: Optional[ThreadPoolExecutor] = None # Overlaps independent REST calls; created on open()
 
     def __enter__(self):
         """
@@ -47,64 +61,144 @@ class GuacamoleClient:
         if self.guacamole is not None and self._is_initialized:
             logger.warning("Guacamole client already initialized. Re-entering context.")
             return self
-
-        try:
-            # Attempt to initialize the Guacamole API client.
-            # This is where the actual connection/authentication to Guacamole happens.
-            self.guacamole = Guacamole(
-                hostname=self.guac_hostname,
-                username=self.guac_username,
-                password=self.guac_password,
-                method=self.GUAC_METHOD,
-                url_path=self.GUAC_URL_PATH,
-                verify=self.GUAC_VERIFY_SSL,
-            )
-            self._is_initialized = True
-            logger.info(f"Guacamole client successfully initialized for {self.guac_hostname} upon entering 'with' block.")
-            return self # Return self to be bound to 'as' variable in 'with' statement
-        except (requests.exceptions.RequestException, AssertionError) as e:
-            logger.error(f"Failed to initialize Guacamole client upon entering 'with' block: {e}", exc_info=True)
-            self.guacamole = None
-            self._is_initialized = False
-            # Re-raise the exception to indicate failure to the caller of the 'with' statement
-            raise
-        except Exception as e:
-            logger.critical(f"An unexpected error occurred during Guacamole client initialization in __enter__: {e}", exc_info=True)
-            self.guacamole = None
-            self._is_initialized = False
-            raise
+        return self.open()
 
     def __exit__(self, exc_type, exc_value, traceback):
         """
         Exits the runtime context related to this object.
         This method is called when the 'with' block is exited,
         regardless of whether an exception occurred.
+        """
+        self.close()
+        # If __exit__ returns True, it suppresses the exception.
+        # We generally want exceptions to propagate, so we let it return None (default).
+        return False # Returning False (or implicitly None) allows exceptions to propagate.
+
+    def _new_session(self) -> requests.Session:
+        """Creates a pooled HTTP session so REST calls reuse TCP/TLS connections."""
+        session = requests.Session()
+        session.verify = self.GUAC_VERIFY_SSL
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def open(self):
+        """
+        Logs in to the Guacamole server and obtains an auth token.
+        Calling it again on an open client re-authenticates with a fresh token.
+        """
+        with self._lock:
+            if self.session is None:
+                self.session = self._new_session()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='guac')
+            try:
+                # Attempt to initialize the Guacamole API client.
+                # This is where the actual connection/authentication to Guacamole happens.
+                self.guacamole = Guacamole(
+                    hostname=self.guac_hostname,
+                    username=self.guac_username,
+                    password=self.guac_password,
+                    method=self.GUAC_METHOD,
+                    url_path=self.GUAC_URL_PATH,
+                    verify=self.GUAC_VERIFY_SSL,
+                    session=self.session,
+                )
+                self._is_initialized = True
+                logger.info(f"Guacamole client successfully initialized for {self.guac_hostname}.")
+                return self # Return self to be bound to 'as' variable in 'with' statement
+            except (requests.exceptions.RequestException, AssertionError) as e:
+                logger.error(f"Failed to initialize Guacamole client: {e}", exc_info=True)
+                self.guacamole = None
+                self._is_initialized = False
+                # Re-raise the exception to indicate failure to the caller
+                raise
+            except Exception as e:
+                logger.critical(f"An unexpected error occurred during Guacamole client initialization: {e}", exc_info=True)
+                self.guacamole = None
+                self._is_initialized = False
+                raise
+
+    def refresh(self):
+        """Re-authenticates against the Guacamole server to obtain a fresh auth token."""
+        logger.info(f"Refreshing Guacamole auth token for {self.guac_hostname}.")
+        self.open()
+
+    def close(self):
+        """
+        Releases the Guacamole client.
         It sets self.guacamole to None to explicitly release the reference.
         """
         if self.guacamole and self._is_initialized:
-            logger.info("Guacamole client context exiting. Releasing client reference.")
+            logger.info("Guacamole client closing. Releasing client reference.")
             # If your Guacamole client doesn't have an explicit logout method,
             # simply setting self.guacamole to None allows the object to be garbage collected.
             # The session will then naturally expire on the Guacamole server side.
             self.guacamole = None
             self._is_initialized = False
         else:
-            logger.warning("Guacamole client not active, no reference to release on __exit__.")
+            logger.warning("Guacamole client not active, no reference to release on close.")
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
 
-        # If __exit__ returns True, it suppresses the exception.
-        # We generally want exceptions to propagate, so we let it return None (default).
-        return False # Returning False (or implicitly None) allows exceptions to propagate.
+    def _ensure_open(self) -> Optional[str]:
+        """Opens the client if needed. Returns an error message on failure, None otherwise."""
+        if self.guacamole and self._is_initialized:
+            return None
+        try:
+            self.open()
+            return None
+        except Exception as e:
+            error_message = f"Guacamole client could not be initialized: {e}"
+            logger.error(error_message)
+            return error_message
+
+    def _call(self, name, *args, **kwargs):
+        """
+        Calls the Guacamole REST method `name`. If Guacamole rejects the auth token, re-authenticates
+        once and retries only this request, so a multi-step operation never repeats steps that
+        already succeeded. Lets a long-lived GuacamoleClient survive server-side session expiry.
+        """
+        try:
+            return getattr(self.guacamole, name)(*args, **kwargs)
+        except requests.exceptions.HTTPError as e:
+            if not self._is_token_rejected(e):
+                raise
+            logger.warning(f"Guacamole auth token rejected on {name}, re-authenticating and retrying.")
+            self.refresh()
+            return getattr(self.guacamole, name)(*args, **kwargs)
+
+    def _rollback(self, name, *args, **kwargs):
+        """Best-effort undo of a partially applied operation; failures are only logged."""
+        try:
+            self._call(name, *args, **kwargs)
+        except Exception as e:
+            logger.warning(f"Guacamole rollback {name} failed: {e}")
+
+    def _rollback_grant(self, username, connection_id):
+        """Removes the user and connection created by a grant_user_permissions call that failed later on."""
+        if connection_id:
+            self._rollback('delete_connection', connection_id=connection_id)
+        self._rollback('delete_user', username)
 
     @staticmethod
+    def _is_token_rejected(e: requests.exceptions.HTTPError) -> bool:
+        """Whether an HTTP error means the auth token has expired or is invalid."""
+        return e.response is not None and e.response.status_code in (401, 403)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
     def strtobase64(id: str) -> str:
         """
         Converts a string ID to a Base64 format typically used by Guacamole
         for client URLs. It appends 'cpostgresql' and removes trailing '=' if present.
         """
-        suffix_bytes = b'\x00c\x00postgresql'
-        combined_bytes = id.encode('utf-8') + suffix_bytes
-        encoded = base64.b64encode(combined_bytes).decode('utf-8')
-        return encoded.rstrip('=')
+        return base64.b64encode(id.encode('utf-8') + _GUAC_SUFFIX).rstrip(b'=').decode('ascii')
 
     def grant_user_permissions(self,
         username: str,
@@ -129,53 +223,74 @@ class GuacamoleClient:
                 - Optional[str]: The Guacamole client URL if successful, None if failed.
                 - str: A status message ("Success" or an error description).
         """
-        # Ensure the Guacamole client was successfully initialized by __enter__.
-        if not self.guacamole or not self._is_initialized:
-            error_message = "Guacamole client was not successfully initialized or is not active. Please use 'with' statement correctly."
-            logger.error(error_message)
+        # Ensure the Guacamole client is initialized (logs in lazily if needed).
+        error_message = self._ensure_open()
+        if error_message:
             return False, error_message
 
         connection_id: Optional[str] = None # Explicitly type as Optional
 
         try:
-            # 1. Add user
-            logger.info(f"Attempting to add user '{username}' to Guacamole.")
-            user_payload = copy.deepcopy(USER)
+            # 1. Add user and 2. add connection are independent, so issue them concurrently
+            conn_name = f"vm_{username}"
+            logger.info(f"Attempting to add user '{username}' and VNC connection '{conn_name}' for {vnchost}:{vncport}.")
+            user_payload = orjson.loads(_USER_TMPL_JSON)
             user_payload["username"] = username
             user_payload["password"] = userpwd
-            self.guacamole.add_user(user_payload)
-            logger.info(f"User '{username}' successfully added or already exists.")
 
-            # 2. Add connection
-            conn_name = f"vm_{username}"
-            logger.info(f"Attempting to add VNC connection '{conn_name}' for {vnchost}:{vncport}.")
-            conn_payload = copy.deepcopy(VNC_CONNECTION)
+            conn_payload = orjson.loads(_VNC_TMPL_JSON)
             conn_payload["name"] = conn_name
             conn_payload["parameters"]["hostname"] = vnchost
             conn_payload["parameters"]["port"] = str(vncport)
             conn_payload["attributes"]["max-connections"] = str(maxconn)
 
-            new_conn = self.guacamole.add_connection(conn_payload)
+            user_future = self._executor.submit(self._call, 'add_user', user_payload)
+            conn_future = self._executor.submit(self._call, 'add_connection', conn_payload)
+            wait((user_future, conn_future))
 
+            # If only one of the two succeeded, roll it back before reporting the failure
+            user_error, conn_error = user_future.exception(), conn_future.exception()
+            if user_error or conn_error:
+                if user_error is None:
+                    self._rollback('delete_user', username)
+                new_conn = None if conn_error else conn_future.result()
+                if new_conn and "identifier" in new_conn:
+                    self._rollback('delete_connection', connection_id=new_conn["identifier"])
+                raise user_error or conn_error
+            logger.info(f"User '{username}' successfully added or already exists.")
+
+            new_conn = conn_future.result()
             if new_conn and "identifier" in new_conn:
                 connection_id = new_conn["identifier"]
                 logger.info(f"Connection '{conn_name}' added with ID: {connection_id}.")
             else:
                 error_message = f"Failed to get connection identifier for '{conn_name}'. API response: {new_conn}"
                 logger.error(error_message)
+                # Without the identifier the connection can only be found by name
+                try:
+                    conn = self._call('get_connection_by_name', conn_name)
+                except Exception as e:
+                    logger.warning(f"Guacamole rollback get_connection_by_name failed: {e}")
+                    conn = None
+                self._rollback_grant(username, conn["identifier"] if conn else None)
                 return False, error_message
 
             # 3. Grant user read access to the connection
             permission_payload = [{"op": "add", "path": f"/connectionPermissions/{connection_id}", "value": "READ"}]
             logger.info(f"Granting READ permission to user '{username}' for connection {connection_id}.")
 
-            response = self.guacamole.grant_permission(username, permission_payload)
+            try:
+                response = self._call('grant_permission', username, permission_payload)
+            except Exception:
+                self._rollback_grant(username, connection_id)
+                raise
 
             if response.status_code == 204:
                 logger.info(f"Permission successfully granted to user '{username}'.")
             else:
                 error_message = f"Permission grant for user '{username}' failed with unexpected status code: {response.status_code}. Response: {response.text}"
                 logger.error(error_message)
+                self._rollback_grant(username, connection_id)
                 return False, error_message
 
             # 4. Construct the Guacamole client URL
@@ -185,7 +300,7 @@ class GuacamoleClient:
             return True, {"link": guac_client_url, "connid": connection_id, "vncport": vncport}
 
         except requests.exceptions.HTTPError as e:
-            error_message = self._parse_context(e.response.text)
+            error_message = self._parse_context(e.response.content) or f"Guacamole API HTTP error: {e}"
             logger.error(f"HTTP error during permission grant for '{username}': {error_message}", exc_info=True)
             return False, error_message
         except requests.exceptions.ConnectionError as e:
@@ -200,10 +315,6 @@ class GuacamoleClient:
             error_message = f"General Guacamole API request error: {e}"
             logger.error(f"General request error during permission grant for '{username}': {error_message}", exc_info=True)
             return False, error_message
-        except json.JSONDecodeError as e:
-            error_message = f"Failed to parse Guacamole API response JSON: {e}"
-            logger.error(f"JSON decode error during permission grant for '{username}': {error_message}", exc_info=True)
-            return False, error_message
         except KeyError as e:
             error_message = f"Guacamole API response is missing expected data key: {e}"
             logger.error(f"Data parsing error during permission grant for '{username}': {error_message}", exc_info=True)
@@ -217,14 +328,24 @@ class GuacamoleClient:
         """
         delete user and vm link
         """
-        if not self.guacamole or not self._is_initialized:
-            error_message = "Guacamole client was not successfully initialized or is not active. Please use 'with' statement correctly."
-            logger.error(error_message)
+        error_message = self._ensure_open()
+        if error_message:
             return False, error_message
         
         try:
-            self.guacamole.delete_connection(connection_id=connid)
-            self.guacamole.delete_user(name)
+            # connid 未知时（服务重启或前端尚未同步），按 grant_user_permissions 使用的名称查找连接
+            if not connid:
+                conn = self._call('get_connection_by_name', f"vm_{name}")
+                connid = conn["identifier"] if conn else None
+            # connid 仍为空说明 Guacamole 连接尚未创建成功
+            if connid:
+                self._call('delete_connection', connection_id=connid)
+            try:
+                self._call('delete_user', name)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                logger.info(f"Guacamole user '{name}' does not exist, nothing to delete.")
             return True, "Delete Successfully"
         except Exception as e:
             error_message = f"Deleting user and link failed for '{name}': {e}"
@@ -234,11 +355,18 @@ class GuacamoleClient:
     def _parse_context(self, rawdata: bytes) -> Optional[str]:
         """
         parse json byte
+        Only "already exists" errors are of interest, so other bodies are rejected by a bytes substring check without parsing.
         """
-        json_str = rawdata.decode('utf-8')
-        data = json.loads(json_str)
+        if b'"BAD_REQUEST"' not in rawdata or b'already exists' not in rawdata:
+            return None
+        try:
+            data = orjson.loads(rawdata)
+            message = data['translatableMessage']['variables']['MESSAGE']
+            error_type = data.get('type')
+        except (orjson.JSONDecodeError, KeyError, TypeError, AttributeError):
+            return None
 
         # user already exists
-        if data["type"] == "BAD_REQUEST" and "already exists" in data['translatableMessage']['variables']['MESSAGE']:
-            return data['translatableMessage']['variables']['MESSAGE']
+        if error_type == "BAD_REQUEST" and "already exists" in message:
+            return message
         return None
@@ -1,11 +1,17 @@
 # uvicorn libvirt_server:app --host 127.0.0.1 --port 5001 --workers 1
 import os
 import sys
+import time
+import asyncio
+import threading
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, status
+from fastapi import FastAPI, HTTPException, BackgroundTasks, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import uvicorn
 import urllib3
+import orjson
 
 from log import logger
 from vm_libvirt_manager import LibvirtManager
@@ -24,7 +30,7 @@ class VMCreateRequest(BaseModel):
 
 class VMDelete(BaseModel):
     vm_name: str = Field(..., description="Virtual Machine Name")
-    connid: int = Field(..., gt=0, description="Virtual Machine Connect ID")
+    connid: int | None = Field(None, gt=0, description="Virtual Machine Connect ID")
 
 class VMCreateResponse(BaseModel):
     message: str
@@ -37,9 +43,8 @@ class VMCreateResponse(BaseModel):
                 "message": "Virtual machine created successfully",
                 "success": True,
                 "data": {
-                    "link": "https://192.168.3.132:8443/#/client/MTA5AGMAcG9zdGdyZXNxbA",
-                    "connid": 2,
-                    "vncport": 5900
+                    "vncport": 5900,
+                    "status": "provisioning"
                 }
             }
         }
@@ -75,35 +80,87 @@ class VMActionResponse(BaseModel):
             }
         }
 
-class VMDetails(BaseModel):
+class VMSummary(BaseModel):
     name: str
     uuid: str
     status: str
     memory_mb: int
     vcpu_count: int
+    link: str | None = None
+    connid: int | None = None
+
+class VMDetails(VMSummary):
     vnc_port: int | None
     autostart: bool
     disk_path: str
 
 class VMListResponse(BaseModel):
-    vms: list[VMDetails]
+    vms: list[VMDetails | VMSummary]
 
 GUAC_IP: str = os.getenv("GUAC_SERVER_IP", "192.168.3.132:8443")
 VNC_IP: str = os.getenv("VNC_CLIENT_IP", "192.168.3.91")
+# Guacamole 会话在空闲一段时间后过期（默认 60 分钟），定期刷新令牌
+GUAC_TOKEN_REFRESH_SECONDS: int = int(os.getenv("GUAC_TOKEN_REFRESH_SECONDS", "1800"))
+# guac_links 持久化文件，服务重启后仍能返回链接并删除对应的 Guacamole 连接
+GUAC_LINKS_FILE: str = os.getenv("GUAC_LINKS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "guac_links.json"))
+# 后台创建 Guacamole 访问失败时的尝试次数
+GUAC_PROVISION_ATTEMPTS: int = int(os.getenv("GUAC_PROVISION_ATTEMPTS", "3"))
 
 # --- FastAPI application initialization ---
 app = FastAPI(
     title="Libvirt VM Management API",
     description="RESTful API for managing virtual machines via Libvirt.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+def load_guac_links() -> dict[str, dict]:
+    """Loads the Guacamole links saved by a previous run from GUAC_LINKS_FILE."""
+    try:
+        with open(GUAC_LINKS_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.error(f"Failed to load Guacamole links from '{GUAC_LINKS_FILE}': {e}")
+        return {}
+
+def save_guac_links():
+    """Writes guac_links to GUAC_LINKS_FILE, replacing the file atomically."""
+    with guac_links_lock:
+        data = orjson.dumps(guac_links)
+        tmp_path = f"{GUAC_LINKS_FILE}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, GUAC_LINKS_FILE)
+        except OSError as e:
+            logger.error(f"Failed to save Guacamole links to '{GUAC_LINKS_FILE}': {e}")
+
+# 后台任务中创建的 Guacamole 访问信息 {vm_name: {"link": ..., "connid": ...}}
+# 通过 /api/v1/vms 返回给前端，由前端写入自己的数据库；同时保存到 GUAC_LINKS_FILE
+guac_links: dict[str, dict] = load_guac_links()
+guac_links_lock = threading.Lock()
+
 # 初始化 LibvirtManager
 # **重要提示：** LibvirtManager 的连接和权限（包括 sudo 免密配置）
 # 应该在服务器启动前或内部处理好。这个服务器将以特定用户身份运行，
 # 该用户在 /etc/sudoers 中配置了对 libvirt 和 qemu-img 命令的免密权限。
 libvirt_manager = LibvirtManager()
 
+# 所有请求共享一个已认证的 Guacamole 客户端，避免每次操作都重新获取令牌
+guac_client = GuacamoleClient(guac_hostname = GUAC_IP)
+
+async def refresh_guacamole_token():
+    """Periodically re-authenticates the shared Guacamole client before its session expires."""
+    while True:
+        await asyncio.sleep(GUAC_TOKEN_REFRESH_SECONDS)
+        try:
+            await run_in_threadpool(guac_client.refresh)
+        except Exception as e:
+            # 下一次调用 Guacamole 时会重新登录
+            logger.warning(f"Failed to refresh Guacamole auth token: {e}")
+
 @app.on_event("startup")
 async def startup_event():
     """
@@ -117,30 +174,117 @@ async def startup_event():
         logger.info(f"Guacamole Server IP: {GUAC_IP}")
         logger.info(f"VNC Client IP (for VMs): {VNC_IP}")
 
+    try:
+        await run_in_threadpool(guac_client.open)
+    except Exception as e:
+        logger.error(f"Guacamole login failed on startup, will retry on first use: {e}")
+    app.state.guac_refresh_task = asyncio.create_task(refresh_guacamole_token())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    This event is executed when the application stops, used to release the shared Guacamole client.
+    """
+    app.state.guac_refresh_task.cancel()
+    guac_client.close()
+
+def merge_guac_link(vm_info: dict) -> dict:
+    """Adds the Guacamole link and connection ID provisioned for the VM, if any."""
+    vm_info.update(guac_links.get(vm_info['name'], {}))
+    return vm_info
+
+def stream_vm_list(vms_info):
+    """
+    Serializes the VM list one VM at a time as {"vms": [...]}, matching VMListResponse.
+    Sync generator, so Starlette iterates it in a worker thread while libvirt details arrive.
+    The 200 status is sent before the first VM, so an error part-way only ends the body early;
+    the truncated document is not valid JSON, so clients cannot mistake it for a complete list.
+    """
+    yield b'{"vms":['
+    try:
+        for i, vm_info in enumerate(vms_info):
+            yield (b',' if i else b'') + orjson.dumps(merge_guac_link(vm_info))
+    except Exception as e:
+        logger.error(f"Error streaming VM list: {e}", exc_info=True)
+        raise
+    yield b']}'
+
 @app.get("/api/v1/vms", response_model=VMListResponse, summary="List all Virtual Machines")
-async def list_vms():
+async def list_vms(detailed: bool = True):
     """
     Lists all virtual machines defined or running in Libvirt and their detailed status.
+    With detailed=false only status, memory and vCPUs are returned, which skips the per-VM XML lookups.
+    Complete listings (served from the VM cache, or detailed=false) are returned as a regular
+    response validated against VMListResponse. An uncached detailed listing is streamed while each
+    VM's details arrive; that body follows the same schema but bypasses response_model validation.
     """
-    logger.info("Received request to list VMs.")
+    logger.debug("Received request to list VMs.")
     try:
-        vms_info = libvirt_manager.list_vms()
-        return VMListResponse(vms=vms_info)
+        vms_info = libvirt_manager.list_vms_detailed() if detailed else libvirt_manager.list_vms_fast()
+        if isinstance(vms_info, list):
+            return {"vms": [merge_guac_link(vm_info) for vm_info in vms_info]}
     except Exception as e:
         logger.error(f"Error listing VMs: {e}", exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to list VMs: {e}"
         )
+    return StreamingResponse(stream_vm_list(vms_info), media_type="application/json")
+
+@app.get("/api/v1/vms/{vm_name}", response_model=VMDetails, summary="Get a Virtual Machine")
+async def get_vm(vm_name: str):
+    """
+    Gets the detailed status of a specified virtual machine.
+    """
+    logger.debug(f"Received request for VM: {vm_name}")
+    vm_info = libvirt_manager.get_vm_details(vm_name)
+    if vm_info:
+        return VMDetails(**merge_guac_link(vm_info))
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"VM '{vm_name}' does not exist."
+        )
+
+def provision_guacamole(vm_name: str, vm_pwd: str, vnc_port: int):
+    """
+    Creates the Guacamole user and VNC connection for a new virtual machine.
+    Runs as a background task after the create response has been sent;
+    failures are retried up to GUAC_PROVISION_ATTEMPTS times.
+    """
+    for attempt in range(1, GUAC_PROVISION_ATTEMPTS + 1):
+        try:
+            success, data = guac_client.grant_user_permissions(
+                username=vm_name,
+                userpwd=vm_pwd,
+                vnchost=VNC_IP,
+                vncport=vnc_port
+            )
+        except Exception as e:
+            success, data = False, e
+
+        if success:
+            with guac_links_lock:
+                guac_links[vm_name] = {"link": data["link"], "connid": int(data["connid"])}
+            save_guac_links()
+            logger.info(f"VM '{vm_name}': {data['link']}")
+            return
+        logger.error(f"Failed to provision Guacamole access for VM '{vm_name}' (attempt {attempt}/{GUAC_PROVISION_ATTEMPTS}): {data}")
+        if attempt < GUAC_PROVISION_ATTEMPTS:
+            time.sleep(2 * attempt)
+            # 清理失败尝试可能遗留的用户和连接，否则重试会因 "already exists" 失败
+            guac_client.delete_user_and_vm(name=vm_name, connid=None)
 
 @app.post("/api/v1/vms", 
     response_model=VMCreateResponse, 
     status_code=status.HTTP_201_CREATED, 
     summary="Create a new Virtual Machine",
 )
-async def create_vm(request_data: VMCreateRequest):
+async def create_vm(request_data: VMCreateRequest, background_tasks: BackgroundTasks):
     """
     Creates a new virtual machine with the provided name, memory, and number of CPUs.
+    Guacamole access is provisioned in the background; the link and connection ID
+    show up in the VM listing once it is done.
     """
     logger.info(f"Received request to create VM: {request_data.vm_name}")
     try:
@@ -148,40 +292,14 @@ async def create_vm(request_data: VMCreateRequest):
             request_data.vm_name, request_data.memory_mb, request_data.vcpu_count
         )
         if success:
-            with GuacamoleClient(
-                guac_hostname = GUAC_IP
-            ) as guac:
-                if isinstance(result, dict):
-                    status, data = guac.grant_user_permissions(
-                        username=request_data.vm_name, 
-                        userpwd=request_data.vm_pwd, 
-                        vnchost=VNC_IP,
-                        vncport=result["vnc_port"]
-                    )
-
-                    if status:
-                        logger.info(f"VM '{request_data.vm_name}': {data['link']}")
-                        return VMCreateResponse(
-                            message=f"Virtual machine '{request_data.vm_name}' created and started successfully.",
-                            success=True,
-                            data=data
-                        )
-                    else:
-                        return VMCreateResponse(
-                            message=f"Virtual machine '{data}' created failed",
-                            success=False,
-                            data=None
-                        )
-                else:
-                    # raise HTTPException(
-                    #     status_code=status.HTTP_400_BAD_REQUEST,
-                    #     detail=f"Failed to create VM: {result}"
-                    # )
-                    return VMCreateResponse(
-                        message=data,
-                        success=False,
-                        data=None
-                    )
+            background_tasks.add_task(
+                provision_guacamole, request_data.vm_name, request_data.vm_pwd, result["vnc_port"]
+            )
+            return VMCreateResponse(
+                message=f"Virtual machine '{request_data.vm_name}' created and started successfully.",
+                success=True,
+                data={"vncport": result["vnc_port"], "status": "provisioning"}
+            )
         else:
             logger.error(f"Failed to create VM '{request_data.vm_name}': {result}")
             # raise HTTPException(
@@ -256,8 +374,14 @@ async def delete_vm(request_data: VMDelete):
     logger.info(f"Received request to delete VM: {request_data.vm_name}:{request_data.connid}")
     success, message = libvirt_manager.delete_vm(request_data.vm_name)
     if success:
-        with GuacamoleClient(guac_hostname = GUAC_IP) as guac:
-            status, msg = guac.delete_user_and_vm(name=request_data.vm_name, connid=request_data.connid)
+        # 前端可能还没有同步到 connid，此时使用后台任务记录下来的值
+        # 两者都没有时由 delete_user_and_vm 按名称查找连接
+        with guac_links_lock:
+            guac_info = guac_links.pop(request_data.vm_name, {})
+        if guac_info:
+            save_guac_links()
+        connid = request_data.connid or guac_info.get("connid")
+        status, msg = guac_client.delete_user_and_vm(name=request_data.vm_name, connid=connid)
         if status:
             return VMActionResponse(message=message, success=True)
         else:
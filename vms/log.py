@@ -1,5 +1,18 @@
+import atexit
 import logging 
+import logging.handlers
+import queue
 
 # 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
\ No newline at end of file
+# 请求线程只把日志记录放入队列，由后台 QueueListener 线程负责写出，避免在请求路径上做 I/O
+_log_queue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_listener = logging.handlers.QueueListener(_log_queue, _stream_handler, respect_handler_level=True)
+_listener.start()
+atexit.register(_listener.stop) # Flush queued records on exit
+
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s')) # Final formatting is done by _stream_handler
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+logger = logging.getLogger(__name__)
@@ -1,33 +1,325 @@
 import os, re
-import uuid
+import atexit
+import copy
+import functools
 import libvirt
 import subprocess
-from typing import Tuple, Union, Dict, List
-import xml.etree.ElementTree as ET
-import socket # For VNC port check
+import grp
+import pwd
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Union, Dict, List, Iterator
+from lxml import etree as ET
 
 from log import logger
 from config import LIBVIRT_URI, VM_STORAGE_POOL_PATH, BASE_IMAGE_PATH
 
+# Group that owns VM disk images (root:libvirt, mode 0660); None if the group does not exist
+try:
+    _LIBVIRT_GID = grp.getgrnam('libvirt').gr_gid
+except KeyError:
+    _LIBVIRT_GID = None
+
+# Seconds before a sudo system command is abandoned
+_SYSTEM_COMMAND_TIMEOUT = 30
+
+# UNIX socket libvirtd listens on; its presence means the daemon is running
+_LIBVIRT_SOCKET_PATH = '/var/run/libvirt/libvirt-sock'
+
+# Below this many domains, per-domain details are fetched serially instead of on the thread pool
+_PARALLEL_DETAILS_MIN_DOMAINS = 8
+
+# Parsed domain XMLs kept by _domain_xml(): least recently used entries are evicted past the size,
+# and every entry is refetched after the TTL (seconds) even if no event invalidated it
+_DOMAIN_XML_CACHE_SIZE = 256
+_DOMAIN_XML_CACHE_TTL = 300.0
+
+# Stats fetched for every domain in a single getAllDomainStats() call
+_DOMAIN_STATS = libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON
+
+# Domain XML template, parsed once at import; per-VM fields are filled in by _render_domain_xml().
+# The VNC port is allocated by libvirt (autoport) when the VM starts.
+_DOMAIN_XML_TEMPLATE = ET.fromstring(b"""\
+<domain type='kvm'>
+  <name/>
+  <uuid/>
+  <memory unit='MiB'/>
+  <currentMemory unit='MiB'/>
+  <vcpu placement='static'/>
+  <os>
+    <type arch='x86_64' machine='pc-q35-6.2'>hvm</type>
+    <boot dev='hd'/>
+  </os>
+  <features>
+    <acpi/>
+    <apic/>
+    <vmport state='off'/>
+  </features>
+  <cpu mode='host-passthrough' check='none' migratable='on'/>
+  <clock offset='utc'/>
+  <on_poweroff>destroy</on_poweroff>
+  <on_reboot>restart</on_reboot>
+  <on_crash>destroy</on_crash>
+  <devices>
+    <emulator>/usr/bin/qemu-system-x86_64</emulator>
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='qcow2' cache='none' io='io_uring' discard='unmap'/>
+      <source file=''/>
+      <target dev='vda' bus='virtio'/>
+      <address type='pci' domain='0x0000' bus='0x04' slot='0x00' function='0x0'/>
+    </disk>
+    <controller type='usb' index='0' model='qemu-xhci' ports='15'>
+      <address type='pci' domain='0x0000' bus='0x02' slot='0x00' function='0x0'/>
+    </controller>
+    <controller type='pci' index='0' model='pcie-root'/>
+    <controller type='pci' index='1' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='1' port='0x8'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x0'/>
+    </controller>
+    <controller type='pci' index='2' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='2' port='0x9'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x1'/>
+    </controller>
+    <controller type='pci' index='3' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='3' port='0xa'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x2'/>
+    </controller>
+    <controller type='pci' index='4' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='4' port='0xb'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x3'/>
+    </controller>
+    <controller type='pci' index='5' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='5' port='0xc'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x4'/>
+    </controller>
+    <controller type='pci' index='6' model='pcie-root-port'>
+      <model name='pcie-root-port'/>
+      <target chassis='6' port='0xd'/>
+      <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x5'/>
+    </controller>
+    <interface type='network'>
+      <source network='default'/>
+      <model type='virtio'/>
+      <address type='pci' domain='0x0000' bus='0x03' slot='0x00' function='0x0'/>
+    </interface>
+    <console type='pty'>
+      <target type='serial' port='0'/>
+    </console>
+    <serial type='pty'>
+        <target port='0'/>
+    </serial>
+    <channel type='unix'>
+      <target type='virtio' name='org.qemu.guest_agent.0'/>
+      <address type='virtio-serial' controller='0' bus='0' port='1'/>
+    </channel>
+    <input type='tablet' bus='usb'/>
+    <input type='keyboard' bus='ps2'/>
+    <graphics type='vnc' autoport='yes' listen='0.0.0.0'>
+      <listen type='address' address='0.0.0.0'/>
+    </graphics>
+    <video>
+      <model type='qxl' vram='65536' primary='yes'/>
+      <address type='pci' domain='0x0000' bus='0x01' slot='0x00' function='0x0'/>
+    </video>
+    <memballoon model='virtio'>
+      <address type='pci' domain='0x0000' bus='0x05' slot='0x00' function='0x0'/>
+    </memballoon>
+  </devices>
+  <seclabel type='dynamic' model='dac' relabel='yes'/>
+</domain>
+""", ET.XMLParser(remove_blank_text=True))
+
+# io='io_uring' needs libvirt >= 6.3.0 and a host kernel >= 5.1
+_IO_URING_MIN_LIBVIRT_VERSION = 6003000
+_IO_URING_MIN_KERNEL = (5, 1)
+
+def _render_domain_xml(vm_name, vm_uuid, memory_mb, vcpu_count, disk_path, disk_io='io_uring') -> str:
+    """Returns the domain XML for a new VM, built from a copy of _DOMAIN_XML_TEMPLATE."""
+    root = copy.deepcopy(_DOMAIN_XML_TEMPLATE)
+    root.find('name').text = vm_name
+    root.find('uuid').text = vm_uuid
+    root.find('memory').text = str(memory_mb)
+    root.find('currentMemory').text = str(memory_mb)
+    root.find('vcpu').text = str(vcpu_count)
+    root.find("devices/disk/source").set('file', disk_path)
+    root.find("devices/disk/driver").set('io', disk_io)
+    return ET.tostring(root, encoding='unicode')
+
+def _render_volume_xml(vol_name, capacity) -> str:
+    """Returns the XML for a qcow2 overlay volume backed by BASE_IMAGE_PATH; lxml escapes the VM-supplied name."""
+    root = ET.Element('volume')
+    ET.SubElement(root, 'name').text = vol_name
+    ET.SubElement(root, 'capacity', unit='bytes').text = str(capacity)
+    target = ET.SubElement(root, 'target')
+    ET.SubElement(target, 'format', type='qcow2')
+    # Let libvirt apply the ownership the sudo chown/chmod calls used to set
+    if _LIBVIRT_GID is not None:
+        permissions = ET.SubElement(target, 'permissions')
+        ET.SubElement(permissions, 'owner').text = '0'
+        ET.SubElement(permissions, 'group').text = str(_LIBVIRT_GID)
+        ET.SubElement(permissions, 'mode').text = '0660'
+    backing = ET.SubElement(root, 'backingStore')
+    ET.SubElement(backing, 'path').text = BASE_IMAGE_PATH
+    ET.SubElement(backing, 'format', type='qcow2')
+    return ET.tostring(root, encoding='unicode')
+
+_event_loop_lock = threading.Lock()
+_event_loop_started = False
+# Consecutive failed iterations after which the event loop gives up
+_EVENT_LOOP_MAX_FAILURES = 10
+
+def _start_libvirt_event_loop(on_stopped) -> bool:
+    """
+    Registers libvirt's default event loop implementation and runs it on a daemon thread.
+    Must happen before connections are opened for them to deliver domain events.
+    on_stopped is called if the loop has to give up after repeated failures.
+    Returns whether the event loop is running.
+    """
+    global _event_loop_started
+    with _event_loop_lock:
+        if _event_loop_started:
+            return True
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except libvirt.libvirtError as e:
+            logger.warning(f"Failed to register libvirt event loop, domain events disabled: {e}")
+            return False
+
+        def run():
+            global _event_loop_started
+            failures = 0
+            while failures < _EVENT_LOOP_MAX_FAILURES:
+                try:
+                    libvirt.virEventRunDefaultImpl()
+                    failures = 0
+                except Exception as e:
+                    failures += 1
+                    logger.error(f"libvirt event loop iteration failed ({failures}/{_EVENT_LOOP_MAX_FAILURES}): {e}")
+                    time.sleep(1)
+            logger.error("libvirt event loop stopped, domain events disabled.")
+            with _event_loop_lock:
+                _event_loop_started = False
+            on_stopped()
+
+        threading.Thread(target=run, name='libvirt-events', daemon=True).start()
+        _event_loop_started = True
+        return True
+
+def _fast_uuid4() -> str:
+    """Returns a random (version 4) UUID string, without building a uuid.UUID object."""
+    b = bytearray(os.urandom(16))
+    b[6] = (b[6] & 0x0f) | 0x40 # version 4
+    b[8] = (b[8] & 0x3f) | 0x80 # RFC 4122 variant
+    h = b.hex()
+    return f"{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+
+def _is_connection_error(e: libvirt.libvirtError) -> bool:
+    """Whether a libvirtError means the connection to libvirtd itself is broken."""
+    code = e.get_error_code()
+    return (code in (libvirt.VIR_ERR_INVALID_CONN, libvirt.VIR_ERR_NO_CONNECT)
+            or (code == libvirt.VIR_ERR_SYSTEM_ERROR and e.get_error_domain() == libvirt.VIR_FROM_RPC))
+
+def _with_libvirt_retry(on_failure=None):
+    """
+    Runs the method on the current connection without probing it first (no isAlive() RPC).
+    If the method re-raises a connection error, reconnects once and retries.
+    on_failure is returned when no connection can be established (a callable is invoked to build it).
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            for _ in range(2):
+                if self.conn is None:
+                    self._connect()
+                if self.conn is None:
+                    break
+                try:
+                    return method(self, *args, **kwargs)
+                except libvirt.libvirtError as e:
+                    if not _is_connection_error(e):
+                        raise
+                    logger.warning(f"Libvirt connection lost ({e}), attempting to reconnect...")
+                    self.conn = None
+            logger.error(f"{method.__name__}: Libvirt connection failed")
+            return on_failure() if callable(on_failure) else on_failure
+        return wrapper
+    return decorator
+
 class LibvirtManager:
+    # libvirt domain state -> human readable status
+    _STATUS_MAP = {
+        libvirt.VIR_DOMAIN_NOSTATE: 'No State',
+        libvirt.VIR_DOMAIN_RUNNING: 'Running',
+        libvirt.VIR_DOMAIN_BLOCKED: 'Blocked',
+        libvirt.VIR_DOMAIN_PAUSED: 'Paused',
+        libvirt.VIR_DOMAIN_SHUTDOWN: 'Shutting Down',
+        libvirt.VIR_DOMAIN_SHUTOFF: 'Shut Off',
+        libvirt.VIR_DOMAIN_CRASHED: 'Crashed',
+        libvirt.VIR_DOMAIN_PMSUSPENDED: 'Suspended',
+    }
+
     # Centralized map for system commands
     _SYSTEM_COMMANDS = {
-        'systemctl_is_active': ['systemctl', 'is-active', 'libvirtd'],
-        'systemctl_start': ['systemctl', 'start', 'libvirtd'],
-        'systemctl_is_enabled': ['systemctl', 'is-enabled', 'libvirtd'],
-        'systemctl_enable': ['systemctl', 'enable', 'libvirtd'],
-        'groups_check': ['groups', '{user}'],
+        'systemctl_enable_now': ['systemctl', 'enable', '--now', 'libvirtd'], # Enables autostart and starts in one call
         'usermod_add_group': ['usermod', '-a', '-G', 'libvirt', '{user}'],
-        'qemu_img_create': ['qemu-img', 'create', '-f', 'qcow2', '-b', '{base_image_path}', '-F', 'qcow2', '{new_disk_path}'],
-        'chown': ['chown', '{owner_group}', '{path}'],
-        'chmod': ['chmod', '{mode}', '{path}'],
-        'rm_force': ['rm', '-f', '{path}'],
     }
+    # Precompiled at class load: (arg, None) for literal args, (arg, arg.format_map) for args with placeholders
+    _SYSTEM_COMMANDS_COMPILED = {
+        key: [(arg, arg.format_map if '{' in arg else None) for arg in args]
+        for key, args in _SYSTEM_COMMANDS.items()
+    }
+
+    # Precompiled XPath expressions, reused for every domain XML
+    # Anchored at <domain>/<devices> so libvirt's XML is not scanned with the descendant axis
+    _DISK_PATH_XPATH = ET.XPath("./devices/disk[target/@dev='vda']/source/@file") # 主磁盘
+    _VNC_PORT_XPATH = ET.XPath("./devices/graphics[@type='vnc']/@port")
+
+    # Process-wide singleton: every caller shares one libvirt connection
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance._initialized = False
+        return cls._instance
 
     def __init__(self, uri=LIBVIRT_URI):
-        self.uri = uri
-        self.conn = None
-        self._initial_setup() 
+        # The whole setup runs under the lock so no caller can see a half-initialized instance
+        with self._instance_lock:
+            if self._initialized:
+                if uri != self.uri:
+                    logger.warning(f"LibvirtManager is already connected to {self.uri}, ignoring uri={uri}")
+                return
+            self.uri = uri
+            self.conn = None
+            self._version = None # Memoized conn.getVersion()
+            self._capabilities = None # Memoized conn.getCapabilities()
+            self._storage_pool = None # Memoized _get_storage_pool()
+            self._base_image_capacity = None # Memoized virtual size of BASE_IMAGE_PATH, in bytes
+            # libvirt releases the GIL during RPCs, so per-domain calls can overlap in threads
+            self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='libvirt')
+            # Parsed domain XML keyed by UUID, stored with the domain ID it was fetched under and its expiry time
+            self._xml_cache: OrderedDict[str, Tuple[int, ET._Element, float]] = OrderedDict()
+            self._xml_cache_lock = threading.Lock()
+            self._disk_io_mode = None # Probed once on first VM creation, see _get_disk_io_mode()
+            # VM listing kept up to date by domain lifecycle events instead of re-listing every domain on each call.
+            # None means cold: (re)built on the next listing. Names in _dirty_vms are refetched before use.
+            self._events_enabled = _start_libvirt_event_loop(self._on_event_loop_stopped)
+            self._vm_cache: Union[Dict[str, Dict], None] = None
+            self._dirty_vms: set = set()
+            self._vm_cache_lock = threading.Lock()
+            atexit.register(self.close)
+            self._initial_setup()
+            self._initialized = True
 
     def _initial_setup(self):
         """
@@ -35,16 +327,25 @@ class LibvirtManager:
         This includes checking the libvirtd service and user group membership.
         """
         logger.info("Starting Libvirt environment initial setup and connection.")
+
+        # 1. Fast path: on an already configured host the connection just works, no system commands needed
+        self._connect()
+        if self.conn:
+            logger.info("Libvirt environment checks completed, connection established successfully.")
+            return
+
+        # 2. Check and fix libvirtd service (a stat of its socket first, systemctl only if it is missing)
+        if os.path.exists(_LIBVIRT_SOCKET_PATH):
+            logger.info("libvirtd socket exists, the service is running.")
+        else:
+            service_ok = self._check_and_fix_libvirt_service()
+            if not service_ok:
+                logger.warning("Libvirtd service issues detected. Connection attempts might fail.")
         
-        # 1. Check and fix libvirtd service
-        service_ok = self._check_and_fix_libvirt_service()
-        if not service_ok:
-            logger.warning("Libvirtd service issues detected. Connection attempts might fail.")
-        
-        # 2. Check and add user to libvirt group
+        # 3. Check and add user to libvirt group
         self._check_and_add_user_to_libvirt_group()
 
-        # 3. Attempt to connect to Libvirt
+        # 4. Attempt to connect to Libvirt again
         self._connect()
         
         if not self.conn:
@@ -68,16 +369,81 @@ class LibvirtManager:
             if self.conn is None:
                 raise Exception(f'Failed to connect to libvirt URI: {self.uri}')
             logger.info(f"Successfully connected to libvirt: {self.uri}")
+            self._version = self._capabilities = None # libvirtd may have been upgraded since the last connection
+            self._storage_pool = self._base_image_capacity = None # Bound to the previous connection
+            self._register_domain_events()
         except libvirt.libvirtError as e:
             logger.error(f"Failed to connect to libvirt: {e}")
             self.conn = None # Ensure connection is None on failure
 
-    def _reconnect(self):
-        """Attempts to reconnect if the connection is lost."""
-        if not self.conn or not self.conn.isAlive():
-            logger.warning("Libvirt connection lost or not established, attempting to reconnect...")
-            self._connect()
-        return self.conn
+    def _register_domain_events(self):
+        """Subscribes the VM cache to lifecycle events of the current connection."""
+        with self._vm_cache_lock:
+            self._vm_cache = None # Events may have been missed while disconnected
+        with self._xml_cache_lock:
+            self._xml_cache.clear()
+        if not self._events_enabled:
+            return
+        try:
+            self.conn.setKeepAlive(5, 3) # Detect a dead connection so the close callback fires
+            self.conn.registerCloseCallback(self._on_connection_closed, None)
+            self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle_event, None)
+        except libvirt.libvirtError as e:
+            logger.warning(f"Failed to register libvirt domain events, VM listing will not be cached: {e}")
+            self._events_enabled = False
+
+    def _on_lifecycle_event(self, conn, dom, event, detail, opaque):
+        """Runs on the libvirt event thread: marks the domain's cached listing entry stale."""
+        if event in (libvirt.VIR_DOMAIN_EVENT_DEFINED, libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+            self._invalidate_domain_xml(dom) # Redefinition keeps UUID and ID, so the XML cache cannot notice it
+        with self._vm_cache_lock:
+            self._dirty_vms.add(dom.name())
+
+    def _mark_vm_dirty(self, vm_name):
+        """
+        Marks a VM's cached listing entry stale right after this process changed it,
+        so the next listing does not depend on the lifecycle event having arrived yet.
+        """
+        with self._vm_cache_lock:
+            self._dirty_vms.add(vm_name)
+
+    def _on_event_loop_stopped(self):
+        """Without events the cache can no longer be kept current: fall back to per-call listings."""
+        with self._vm_cache_lock:
+            self._events_enabled = False
+            self._vm_cache = None
+        with self._xml_cache_lock:
+            self._xml_cache.clear()
+
+    def _on_connection_closed(self, conn, reason, opaque):
+        """Runs on the libvirt event thread when the connection drops."""
+        logger.warning(f"Libvirt connection closed (reason {reason}).")
+        with self._vm_cache_lock:
+            self._vm_cache = None
+
+    def close(self):
+        """Closes the libvirt connection and stops the worker threads. Registered with atexit."""
+        self._executor.shutdown(wait=False)
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except libvirt.libvirtError as e:
+                logger.warning(f"Failed to close libvirt connection: {e}")
+            self.conn = None
+
+    @_with_libvirt_retry()
+    def get_version(self) -> Union[int, None]:
+        """Returns the hypervisor version; fetched once, it does not change while connected."""
+        if self._version is None:
+            self._version = self.conn.getVersion()
+        return self._version
+
+    @_with_libvirt_retry()
+    def get_capabilities(self) -> Union[str, None]:
+        """Returns the host capabilities XML; fetched once, it does not change while connected."""
+        if self._capabilities is None:
+            self._capabilities = self.conn.getCapabilities()
+        return self._capabilities
 
     @staticmethod
     def _run_system_command_sudo(command_template_key, **kwargs):
@@ -89,36 +455,38 @@ class LibvirtManager:
         Returns:
             tuple: (bool success, str output/error_message)
         """
-        if command_template_key not in LibvirtManager._SYSTEM_COMMANDS:
+        compiled_args = LibvirtManager._SYSTEM_COMMANDS_COMPILED.get(command_template_key)
+        if compiled_args is None:
             logger.error(f"Error: Command template '{command_template_key}' not found in _SYSTEM_COMMANDS.")
             return False, f"Command template '{command_template_key}' not found."
 
-        command_args = LibvirtManager._SYSTEM_COMMANDS[command_template_key]
-        
-        # Format the command arguments using kwargs
-        # Ensure all args are strings before formatting
-        formatted_command_args = [arg.format(**kwargs) if '{' in arg and '}' in arg else arg for arg in command_args]
+        # Fill in only the arguments that have placeholders
+        formatted_command_args = [fill(kwargs) if fill else arg for arg, fill in compiled_args]
         
         logger.info(f"Executing system command (might require sudo password): {' '.join(formatted_command_args)}")
         try:
-            process = subprocess.Popen(
+            completed = subprocess.run(
                 ["sudo"] + formatted_command_args,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True # Use text mode for string handling
+                stdin=subprocess.DEVNULL, # sudo prompts on the tty, not stdin
+                capture_output=True,
+                timeout=_SYSTEM_COMMAND_TIMEOUT # A hung systemctl must not block startup forever
             )
-            stdout, stderr = process.communicate()
+            # Decode only when there is output
+            stdout = completed.stdout.decode('utf-8', 'replace').strip() if completed.stdout else ''
             
-            if process.returncode == 0:
+            if completed.returncode == 0:
                 logger.info(f"Command successful: {' '.join(formatted_command_args)}")
                 if stdout:
-                    logger.info(f"stdout: {stdout.strip()}")
-                return True, stdout.strip()
+                    logger.info(f"stdout: {stdout}")
+                return True, stdout
             else:
+                stderr = completed.stderr.decode('utf-8', 'replace').strip() if completed.stderr else ''
                 logger.error(f"Command failed: {' '.join(formatted_command_args)}")
-                logger.error(f"stderr: {stderr.strip()}")
-                return False, stderr.strip()
+                logger.error(f"stderr: {stderr}")
+                return False, stderr
+        except subprocess.TimeoutExpired:
+            logger.error(f"Command timed out after {_SYSTEM_COMMAND_TIMEOUT}s: {' '.join(formatted_command_args)}")
+            return False, f"Command timed out after {_SYSTEM_COMMAND_TIMEOUT}s."
         except FileNotFoundError:
             logger.error(f"Error: Command '{formatted_command_args[0]}' not found. Please ensure it is installed and in your PATH.")
             return False, f"Command '{formatted_command_args[0]}' not found."
@@ -128,48 +496,36 @@ class LibvirtManager:
 
     def _check_and_fix_libvirt_service(self):
         """Checks and attempts to fix the libvirtd service status."""
-        logger.info("Checking libvirtd service status...")
-        
-        # Check if service is active
-        success, output = self._run_system_command_sudo('systemctl_is_active')
-        if success and output == 'active':
-            logger.info("libvirtd service is running.")
-        else:
-            logger.info("libvirtd service is not running or inactive, attempting to start...")
-            success, message = self._run_system_command_sudo('systemctl_start')
-            if success:
-                logger.info("libvirtd service successfully started.")
-            else:
-                logger.warning(f"Warning: Failed to start libvirtd service: {message}")
-                logger.warning("Please manually check service status: sudo systemctl status libvirtd")
-                return False
-
-        # Check if service is enabled (autostart on boot)
-        success, output = self._run_system_command_sudo('systemctl_is_enabled') # Assuming this is a typo in original, should be is-enabled
-        if success and output == 'enabled':
-            logger.info("libvirtd service is set to autostart.")
-        else:
-            logger.info("libvirtd service is not set to autostart, attempting to enable...")
-            success, message = self._run_system_command_sudo('systemctl_enable')
-            if success:
-                logger.info("libvirtd service successfully enabled for autostart.")
-            else:
-                logger.warning(f"Warning: Failed to enable libvirtd service autostart: {message}")
+        logger.info("Ensuring libvirtd service is running and enabled for autostart...")
+
+        # 'enable --now' is idempotent: it starts the service if needed and enables autostart,
+        # replacing separate is-active/start/is-enabled/enable sudo calls
+        success, message = self._run_system_command_sudo('systemctl_enable_now')
+        if not success:
+            logger.warning(f"Warning: Failed to start/enable libvirtd service: {message}")
+            logger.warning("Please manually check service status: sudo systemctl status libvirtd")
+            return False
+        logger.info("libvirtd service is running and enabled for autostart.")
         return True
 
     def _check_and_add_user_to_libvirt_group(self):
         """Checks if the current user is in the libvirt group and adds them if not."""
-        current_user = os.getenv('USER') # Get current username
-        if not current_user:
+        try:
+            user_entry = pwd.getpwuid(os.geteuid()) # Get current user
+        except KeyError:
             logger.warning("Warning: Could not get current username, skipping user group check.")
             return
+        current_user = user_entry.pw_name
 
         logger.info(f"Checking if user '{current_user}' is in 'libvirt' group...")
         
-        # Check user's groups
-        success, output = self._run_system_command_sudo('groups_check', user=current_user)
-        
-        if success and 'libvirt' in output.split():
+        # Check user's groups from the group database, in-process
+        if _LIBVIRT_GID is None:
+            logger.warning("Warning: 'libvirt' group does not exist, skipping user group check.")
+            return
+        in_group = user_entry.pw_gid == _LIBVIRT_GID or current_user in grp.getgrgid(_LIBVIRT_GID).gr_mem
+
+        if in_group:
             logger.info(f"User '{current_user}' is already in the 'libvirt' group.")
         else:
             logger.info(f"User '{current_user}' is not in 'libvirt' group, attempting to add...")
@@ -181,334 +537,469 @@ class LibvirtManager:
                 logger.warning(f"Warning: Failed to add user '{current_user}' to 'libvirt' group: {message}")
                 logger.warning("Please manually execute: sudo usermod -a -G libvirt $(whoami) and re-login.")
 
-    def list_vms(self) -> List:
-        """Lists all virtual machines and their statuses."""
-        conn = self._reconnect()
-        if not conn: 
-            return []
-
-        vms_info = []
+    def _get_all_domain_stats(self, filter_flags=0) -> Union[List, None]:
+        """
+        Returns (domain, stats) pairs for every active and inactive domain from a single
+        getAllDomainStats() RPC, with state, vCPU and memory stats. None if the call failed.
+        filter_flags (VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE, ..._RUNNING, ...) restrict the
+        domains on the libvirt side.
+        """
         try:
-            domain_ids = conn.listDomainsID()
-            for dom_id in domain_ids:
-                dom = conn.lookupByID(dom_id)
-                vms_info.append(self._get_domain_details(dom))
-
-            inactive_domains = conn.listDefinedDomains()
-            for dom_name in inactive_domains:
-                dom = conn.lookupByName(dom_name)
-                # Avoid adding duplicates if already listed from active domains
-                if not any(vm['name'] == dom_name for vm in vms_info):
-                    vms_info.append(self._get_domain_details(dom))
+            return self.conn.getAllDomainStats(_DOMAIN_STATS, filter_flags)
         except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             logger.error(f"Failed to list virtual machines: {e}")
-        return vms_info
+            return None
 
-    def _get_domain_details(self, dom) -> Dict:
-        """Retrieves detailed information for a single domain."""
-        if not dom: return {}
-        
-        info = dom.info()
-        status_map = {
-            libvirt.VIR_DOMAIN_NOSTATE: 'No State',
-            libvirt.VIR_DOMAIN_RUNNING: 'Running',
-            libvirt.VIR_DOMAIN_BLOCKED: 'Blocked',
-            libvirt.VIR_DOMAIN_PAUSED: 'Paused',
-            libvirt.VIR_DOMAIN_SHUTDOWN: 'Shutting Down',
-            libvirt.VIR_DOMAIN_SHUTOFF: 'Shut Off',
-            libvirt.VIR_DOMAIN_CRASHED: 'Crashed',
-            libvirt.VIR_DOMAIN_PMSUSPENDED: 'Suspended',
-        }
-        status = status_map.get(info[0], 'Unknown State')
-        
-        # Attempt to get VNC port
-        vnc_port = self._get_vnc_port(dom.XMLDesc(0))
+    @_with_libvirt_retry(on_failure=list)
+    def list_vms_fast(self, filter_flags=0) -> List[Dict]:
+        """
+        Lists all virtual machines with at least status, memory and vCPUs.
+        Served from the event-maintained cache when domain events are available;
+        otherwise costs a single RPC in total: no per-domain XMLDesc() or autostart() calls.
+        filter_flags: see _get_all_domain_stats(); filtered listings bypass the cache.
+        """
+        if self._events_enabled and not filter_flags:
+            return self._get_cached_vms()
+        return [self._get_domain_summary(dom, stats) for dom, stats in self._get_all_domain_stats(filter_flags) or []]
+
+    @_with_libvirt_retry(on_failure=list)
+    def list_vms_detailed(self, filter_flags=0) -> Union[List[Dict], Iterator[Dict]]:
+        """
+        Lists all virtual machines and their statuses, including VNC port, autostart and disk path.
+        Served as a list from the event-maintained cache when domain events are available; otherwise
+        returns a lazy iterator so callers can stream results as each domain's details arrive.
+        filter_flags: see _get_all_domain_stats(); filtered listings bypass the cache.
+        """
+        if self._events_enabled and not filter_flags:
+            return self._get_cached_vms()
+        return self._iter_domain_details(filter_flags) or []
+
+    def list_active_vms(self) -> Union[List[Dict], Iterator[Dict]]:
+        """Lists running virtual machines only, filtered by libvirt rather than in Python."""
+        return self.list_vms_detailed(libvirt.VIR_CONNECT_GET_ALL_DOMAINS_STATS_ACTIVE)
+
+    def _iter_domain_details(self, filter_flags=0, failed=None) -> Union[Iterator[Dict], None]:
+        """
+        Fetches details of every domain; per-domain calls run concurrently since there is no bulk XMLDesc.
+        None if the domains could not be listed. Names of domains whose details could not be fetched
+        are appended to failed, if given; see _get_domain_details_safe().
+        """
+        domain_stats = self._get_all_domain_stats(filter_flags)
+        if domain_stats is None:
+            return None
+        fetch = lambda ds: self._get_domain_details_safe(*ds, failed=failed)
+        if len(domain_stats) >= _PARALLEL_DETAILS_MIN_DOMAINS:
+            details = self._executor.map(fetch, domain_stats)
+        else:
+            details = map(fetch, domain_stats) # Task handoff would cost more than it saves on small hosts
+        return (vm_info for vm_info in details if vm_info)
+
+    def _get_cached_vms(self) -> List[Dict]:
+        """
+        Returns copies of the cached VM listing, after (re)building it if cold and refetching
+        only the domains that lifecycle events marked stale since the last call.
+        """
+        with self._vm_cache_lock:
+            cold = self._vm_cache is None
+            dirty, self._dirty_vms = self._dirty_vms, set() # Events arriving from here on are kept for next time
+
+        try:
+            if cold:
+                failed = []
+                details = self._iter_domain_details(failed=failed)
+                if details is None:
+                    return [] # Stay cold and retry on the next call
+                vm_cache = {vm_info['name']: vm_info for vm_info in details}
+                with self._vm_cache_lock:
+                    self._vm_cache = vm_cache
+                    self._dirty_vms.update(failed) # Only summaries are cached for these
+            else:
+                retry = set()
+                for name in dirty:
+                    try:
+                        vm_info = self._get_domain_details(self.conn.lookupByName(name))
+                    except libvirt.libvirtError as e:
+                        if _is_connection_error(e):
+                            raise
+                        if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
+                            # Keep the cached entry, a failed query does not mean the VM is gone
+                            logger.warning(f"Failed to refresh virtual machine '{name}': {e}")
+                            retry.add(name)
+                            continue
+                        vm_info = None # Undefined
+                    with self._vm_cache_lock:
+                        if self._vm_cache is None:
+                            break
+                        if vm_info:
+                            self._vm_cache[name] = vm_info
+                        else:
+                            self._vm_cache.pop(name, None)
+                with self._vm_cache_lock:
+                    self._dirty_vms |= retry
+        except Exception:
+            with self._vm_cache_lock:
+                self._dirty_vms |= dirty # Retry on the next call
+            raise
+
+        with self._vm_cache_lock:
+            # Callers may mutate the returned dicts (e.g. to add Guacamole links)
+            return [dict(vm_info) for vm_info in (self._vm_cache or {}).values()]
+
+    list_vms = list_vms_detailed
+
+    def _get_domain_details_safe(self, dom, stats=None, failed=None) -> Union[Dict, None]:
+        """
+        Like _get_domain_details, but returns None if the domain vanished since it was listed.
+        Connection errors are re-raised for _with_libvirt_retry. On any other error the domain is
+        still listed, with the summary from stats, and its name is appended to failed if given.
+        """
+        try:
+            return self._get_domain_details(dom, stats)
+        except libvirt.libvirtError as e:
+            if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                return None # Undefined since it was listed
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
+            logger.warning(f"Failed to get details of virtual machine '{dom.name()}': {e}")
+            if failed is not None:
+                failed.append(dom.name())
+            return self._get_domain_summary(dom, stats) if stats is not None else None
+
+    def _get_domain_summary(self, dom, stats=None) -> Dict:
+        """
+        Retrieves name, status, memory and vCPUs of a single domain.
+        If stats from getAllDomainStats() are given, no RPC is made (name and UUID are cached locally by libvirt).
+        """
+        if stats is None:
+            state, max_memory_kib, _, vcpu_count, _ = dom.info()
+        else:
+            state = stats.get('state.state', libvirt.VIR_DOMAIN_NOSTATE)
+            max_memory_kib = stats.get('balloon.maximum', 0)
+            vcpu_count = stats.get('vcpu.current', 0)
 
         return {
             'name': dom.name(),
             'uuid': dom.UUIDString(),
-            'status': status,
-            'memory_mb': info[1],
-            'vcpu_count': info[3],
-            'vnc_port': vnc_port,
-            'autostart': dom.autostart() == 1,
-            'disk_path': self._get_disk_path(dom.XMLDesc(0))
+            'status': self._STATUS_MAP.get(state, 'Unknown State'),
+            'memory_mb': max_memory_kib // 1024, # libvirt reports memory in KiB
+            'vcpu_count': vcpu_count,
         }
 
-    def _get_disk_path(self, xml_desc):
-        """Extracts disk file path from libvirt domain XML."""
-        root = ET.fromstring(xml_desc)
-        for disk in root.findall(".//devices/disk"):
-            target = disk.find("target")
-            if target is not None and target.get('dev') == 'vda':  # 主磁盘
-                source = disk.find("source")
-                if source is not None:
-                    return source.get('file')
-        return "Unknown"
-
-    def _get_vnc_port(self, xml_desc):
-        """Extracts VNC port from XML description."""
-        root = ET.fromstring(xml_desc)
-        graphics = root.find(".//graphics[@type='vnc']")
-        if graphics is not None:
-            port = graphics.get('port')
-            if port and port != '-1': # -1 means dynamic allocation
-                return int(port)
+    def _get_domain_details(self, dom, stats=None) -> Dict:
+        """
+        Retrieves detailed information for a single domain.
+        If stats from getAllDomainStats() are given, the dom.info() RPC is skipped.
+        """
+        if not dom: return {}
+
+        vm_info = self._get_domain_summary(dom, stats)
+
+        # Fetch and parse the domain XML once, shared by the VNC port and disk path lookups
+        root = self._domain_xml(dom)
+
+        vm_info.update({
+            'vnc_port': self._extract_vnc_port(root),
+            'autostart': dom.autostart() == 1,
+            'disk_path': self._extract_disk_path(root)
+        })
+        return vm_info
+
+    def _domain_xml(self, dom):
+        """
+        Returns the parsed XML of a domain, fetching it with XMLDesc() only when not cached.
+        Entries are keyed by UUID and tagged with the domain ID, which libvirt changes on every
+        start and sets to -1 on shutdown (dom.ID() is answered locally, without an RPC), so a
+        cached XML never outlives a lifecycle change. Redefinitions keep both, so XMLs are only
+        cached while DEFINED/UNDEFINED events invalidate them, and at most for _DOMAIN_XML_CACHE_TTL.
+        Callers must not modify the returned tree.
+        """
+        dom_uuid, dom_id = dom.UUIDString(), dom.ID()
+        now = time.monotonic()
+        with self._xml_cache_lock:
+            cached = self._xml_cache.get(dom_uuid)
+            if cached is not None and cached[0] == dom_id and cached[2] > now:
+                self._xml_cache.move_to_end(dom_uuid)
+                return cached[1]
+        root = ET.fromstring(dom.XMLDesc(0))
+        if self._events_enabled:
+            with self._xml_cache_lock:
+                self._xml_cache[dom_uuid] = (dom_id, root, now + _DOMAIN_XML_CACHE_TTL)
+                self._xml_cache.move_to_end(dom_uuid)
+                if len(self._xml_cache) > _DOMAIN_XML_CACHE_SIZE:
+                    self._xml_cache.popitem(last=False)
+        return root
+
+    def _invalidate_domain_xml(self, dom):
+        """Drops the cached XML of a domain after it was redefined or undefined."""
+        with self._xml_cache_lock:
+            self._xml_cache.pop(dom.UUIDString(), None)
+
+    def _get_disk_io_mode(self) -> str:
+        """
+        Returns the QEMU disk AIO backend for new VMs: 'io_uring' when both libvirt and the
+        host kernel support it, otherwise 'threads'. The probe runs once and is cached.
+        """
+        if self._disk_io_mode is None:
+            try:
+                lib_version = self.conn.getLibVersion()
+            except libvirt.libvirtError as e:
+                logger.warning(f"io_uring capability probe failed, using io='threads' for now: {e}")
+                return 'threads' # Not cached, probe again next time
+            match = re.match(r'(\d+)\.(\d+)', os.uname().release)
+            kernel = (int(match.group(1)), int(match.group(2))) if match else (0, 0)
+            if lib_version >= _IO_URING_MIN_LIBVIRT_VERSION and kernel >= _IO_URING_MIN_KERNEL:
+                self._disk_io_mode = 'io_uring'
+            else:
+                self._disk_io_mode = 'threads'
+            logger.info(f"Using io='{self._disk_io_mode}' for new VM disks.")
+        return self._disk_io_mode
+
+    def _get_storage_pool(self, conn):
+        """Returns the storage pool that holds VM disk images (VM_STORAGE_POOL_PATH); looked up once per connection."""
+        if self._storage_pool is None:
+            try:
+                self._storage_pool = conn.storagePoolLookupByTargetPath(VM_STORAGE_POOL_PATH)
+            except libvirt.libvirtError:
+                self._storage_pool = conn.storagePoolLookupByName('default')
+        return self._storage_pool
+
+    def _get_base_image_capacity(self, conn) -> int:
+        """
+        Returns the virtual size of the base image, which every overlay disk inherits.
+        The base image is a fixed template, so it is looked up once per connection;
+        raises libvirtError if it is not a volume in any active pool.
+        """
+        if self._base_image_capacity is None:
+            self._base_image_capacity = conn.storageVolLookupByPath(BASE_IMAGE_PATH).info()[1]
+        return self._base_image_capacity
+
+    @staticmethod
+    def _lookup_volume(pool, lookup, key):
+        """
+        Looks up a volume with lookup(key), refreshing the pool and retrying once on a miss:
+        a dir pool does not see files created outside libvirt until it is refreshed.
+        """
+        try:
+            return lookup(key)
+        except libvirt.libvirtError:
+            pool.refresh(0)
+            return lookup(key)
+
+    @classmethod
+    def _extract_disk_path(cls, root):
+        """Extracts disk file path from a parsed libvirt domain XML root element."""
+        paths = cls._DISK_PATH_XPATH(root)
+        return paths[0] if paths else "Unknown"
+
+    @classmethod
+    def _extract_vnc_port(cls, root):
+        """Extracts VNC port from a parsed domain XML root element."""
+        ports = cls._VNC_PORT_XPATH(root)
+        if ports and ports[0] != '-1': # -1 means dynamic allocation
+            return int(ports[0])
         return None # Not found or dynamically allocated
 
+    @_with_libvirt_retry(on_failure=(False, "❌ Libvirt connection failed"))
     def create_vm_from_template(self, vm_name, memory_mb=2048, vcpu_count=2) -> Tuple[bool, Union[str, Dict]]:
         """
         Clones from a base image and creates a new virtual machine.
         This is a fast cloning implementation by copying the QCOW2 image and generating new XML.
         """
-        conn = self._reconnect()
-        if not conn: 
-            return False, "❌ Libvirt connection failed"
-
-        if not os.path.exists(BASE_IMAGE_PATH):
-            return False, f"❌ Base image file does not exist: {BASE_IMAGE_PATH}"
+        conn = self.conn
 
         # Check if VM name already exists
         try:
             conn.lookupByName(vm_name)
             return False, f"Virtual machine '{vm_name}' already exists"
+        except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry; nothing has been changed yet
+            # VM does not exist, can create
+
+        # 1. Clone disk image as a qcow2 overlay volume backed by the base image.
+        # libvirt runs qemu-img itself and owns the file, so no sudo is needed.
+        try:
+            pool = self._get_storage_pool(conn)
+            base_capacity = self._get_base_image_capacity(conn)
+        except libvirt.libvirtError as e:
+            return False, f"❌ Base image volume is not available: {BASE_IMAGE_PATH} ({e})"
+
+        vol_name = f"{vm_name}.qcow2"
+        try:
+            self._lookup_volume(pool, pool.storageVolLookupByName, vol_name).delete(0)
+            logger.info(f"Successfully removed existing disk image: {vol_name}")
         except libvirt.libvirtError:
-            pass # VM does not exist, can create
-
-        # 1. Clone disk image
-        new_disk_path = os.path.join(VM_STORAGE_POOL_PATH, f"{vm_name}.qcow2")
-        if os.path.exists(new_disk_path):
-            success, msg = self._run_system_command_sudo('rm_force', path=new_disk_path)
-            if not success:
-                return False, f"❌ Failed to remove existing disk image: {msg}"
-            logger.info(f"Successfully removed existing disk image: {new_disk_path}")
-
-        success, msg = self._run_system_command_sudo(
-            'qemu_img_create', 
-            base_image_path=BASE_IMAGE_PATH, 
-            new_disk_path=new_disk_path
-        )
-        if not success:
-            return False, f"❌ Failed to clone disk image: {msg}"
-        logger.info(f"Successfully cloned disk image to: {new_disk_path}")
+            pass # No stale volume
 
-        # Set ownership and permissions for the new disk image
-        success, msg = self._run_system_command_sudo('chown', owner_group='root:libvirt', path=new_disk_path)
-        if not success:
-            return False, f"❌ Failed to set disk image ownership: {msg}"
-        success, msg = self._run_system_command_sudo('chmod', mode='g+rw', path=new_disk_path)
-        if not success:
-            return False, f"❌ Failed to set disk image permissions: {msg}"
-        logger.info(f"Set permissions for new disk image: {new_disk_path}")
+        vol_xml = _render_volume_xml(vol_name, base_capacity)
+
+        # 2. Generate VM XML configuration before the disk exists, so a rendering error cannot leak the volume
+        vm_uuid = _fast_uuid4()
+        disk_io = self._get_disk_io_mode()
+        new_disk_path = os.path.join(VM_STORAGE_POOL_PATH, vol_name)
+        xml_config = _render_domain_xml(vm_name, vm_uuid, memory_mb, vcpu_count, new_disk_path, disk_io)
 
-        # 2. Generate VM XML configuration
-        vm_uuid = str(uuid.uuid4())
-        
-        # Find an available VNC port
-        vnc_port = 5900
-        while True:
-            try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.settimeout(0.1)
-                    s.connect(('127.0.0.1', vnc_port))
-                vnc_port += 1
-            except (socket.timeout, ConnectionRefusedError):
-                break # Port is available
-
-        xml_config = f"""
-        <domain type='kvm'>
-          <name>{vm_name}</name>
-          <uuid>{vm_uuid}</uuid>
-          <memory unit='MiB'>{memory_mb}</memory>
-          <currentMemory unit='MiB'>{memory_mb}</currentMemory>
-          <vcpu placement='static'>{vcpu_count}</vcpu>
-          <os>
-            <type arch='x86_64' machine='pc-q35-6.2'>hvm</type>
-            <boot dev='hd'/>
-          </os>
-          <features>
-            <acpi/>
-            <apic/>
-            <vmport state='off'/>
-          </features>
-          <cpu mode='host-passthrough' check='none' migratable='on'/>
-          <clock offset='utc'/>
-          <on_poweroff>destroy</on_poweroff>
-          <on_reboot>restart</on_reboot>
-          <on_crash>destroy</on_crash>
-          <devices>
-            <emulator>/usr/bin/qemu-system-x86_64</emulator>
-            <disk type='file' device='disk'>
-              <driver name='qemu' type='qcow2'/>
-              <source file='{new_disk_path}'/>
-              <target dev='vda' bus='virtio'/>
-              <address type='pci' domain='0x0000' bus='0x04' slot='0x00' function='0x0'/>
-            </disk>
-            <controller type='usb' index='0' model='qemu-xhci' ports='15'>
-              <address type='pci' domain='0x0000' bus='0x02' slot='0x00' function='0x0'/>
-            </controller>
-            <controller type='pci' index='0' model='pcie-root'/>
-            <controller type='pci' index='1' model='pcie-root-port'>
-              <model name='pcie-root-port'/>
-              <target chassis='1' port='0x8'/>
-              <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x0'/>
-            </controller>
-            <controller type='pci' index='2' model='pcie-root-port'>
-              <model name='pcie-root-port'/>
-              <target chassis='2' port='0x9'/>
-              <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x1'/>
-            </controller>
-            <controller type='pci' index='3' model='pcie-root-port'>
-              <model name='pcie-root-port'/>
-              <target chassis='3' port='0xa'/>
-              <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x2'/>
-            </controller>
-            <controller type='pci' index='4' model='pcie-root-port'>
-              <model name='pcie-root-port'/>
-              <target chassis='4' port='0xb'/>
-              <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x3'/>
-            </controller>
-            <controller type='pci' index='5' model='pcie-root-port'>
-              <model name='pcie-root-port'/>
-              <target chassis='5' port='0xc'/>
-              <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x4'/>
-            </controller>
-            <controller type='pci' index='6' model='pcie-root-port'>
-              <model name='pcie-root-port'/>
-              <target chassis='6' port='0xd'/>
-              <address type='pci' domain='0x0000' bus='0x00' slot='0x01' function='0x5'/>
-            </controller>
-            <interface type='network'>
-              <source network='default'/>
-              <model type='virtio'/>
-              <address type='pci' domain='0x0000' bus='0x03' slot='0x00' function='0x0'/>
-            </interface>
-            <console type='pty'>
-              <target type='serial' port='0'/>
-            </console>
-            <serial type='pty'>
-                <target port='0'/>
-            </serial>
-            <channel type='unix'>
-              <target type='virtio' name='org.qemu.guest_agent.0'/>
-              <address type='virtio-serial' controller='0' bus='0' port='1'/>
-            </channel>
-            <input type='tablet' bus='usb'/>
-            <input type='keyboard' bus='ps2'/>
-            <graphics type='vnc' port='{vnc_port}' autoport='no' listen='0.0.0.0'>
-              <listen type='address' address='0.0.0.0'/>
-            </graphics>
-            <video>
-              <model type='qxl' vram='65536' primary='yes'/>
-              <address type='pci' domain='0x0000' bus='0x01' slot='0x00' function='0x0'/>
-            </video>
-            <memballoon model='virtio'>
-              <address type='pci' domain='0x0000' bus='0x05' slot='0x00' function='0x0'/>
-            </memballoon>
-          </devices>
-          <seclabel type='dynamic' model='dac' relabel='yes'/>
-        </domain>
-        """
         try:
+            new_vol = pool.createXML(vol_xml, 0)
+        except libvirt.libvirtError as e:
+            return False, f"❌ Failed to clone disk image: {e}"
+
+        try:
+            if new_vol.path() != new_disk_path: # Pool found by name lives outside VM_STORAGE_POOL_PATH
+                new_disk_path = new_vol.path()
+                xml_config = _render_domain_xml(vm_name, vm_uuid, memory_mb, vcpu_count, new_disk_path, disk_io)
+            logger.info(f"Successfully cloned disk image to: {new_disk_path}")
+
             dom = conn.defineXML(xml_config)
             if dom is None:
                 return False, "❌ Failed to define virtual machine"
+            self._mark_vm_dirty(vm_name)
             
             dom.create() # Start the virtual machine
-            logger.info(f"✅ Virtual machine '{vm_name}' created and started successfully.")
+            # Read back the VNC port libvirt assigned to the running domain
+            vnc_port = self._extract_vnc_port(self._domain_xml(dom))
+            logger.info(f"✅ Virtual machine '{vm_name}' created and started successfully (VNC port {vnc_port}).")
             return True, {"name": vm_name, "vnc_port": vnc_port}
-        except libvirt.libvirtError as e:
-            # Clean up potentially created disk file if VM definition/start fails
-            if os.path.exists(new_disk_path):
-                success, cleanup_msg = self._run_system_command_sudo('rm_force', path=new_disk_path)
-                if success:
-                    logger.error(f"Cleaned up disk image after VM creation failure: {new_disk_path}")
-                else:
-                    logger.error(f"Warning: Failed to clean up disk image '{new_disk_path}' after VM creation error: {cleanup_msg}")
+        except Exception as e:
+            # Clean up the created disk volume if VM definition/start fails
+            try:
+                new_vol.delete(0)
+                logger.error(f"Cleaned up disk image after VM creation failure: {new_disk_path}")
+            except libvirt.libvirtError as cleanup_error:
+                logger.error(f"Warning: Failed to clean up disk image '{new_disk_path}' after VM creation error: {cleanup_error}")
             return False, f"❌ Failed to create virtual machine: {e}"
 
+    @_with_libvirt_retry(on_failure=(False, "❌ Libvirt connection failed"))
     def start_vm(self, vm_name) -> Tuple[bool, Union[str]]:
         """Starts a virtual machine."""
-        conn = self._reconnect()
-        if not conn: 
-            return False, "❌ Libvirt connection failed"
+        conn = self.conn
         try:
             dom = conn.lookupByName(vm_name)
             dom.create()
+            self._mark_vm_dirty(vm_name)
             logger.info(f"Virtual machine '{vm_name}' started successfully.")
             return True, f"✅ Virtual machine '{vm_name}' started successfully."
         except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             return False, f"❌ Failed to start virtual machine '{vm_name}': {e}"
 
+    @_with_libvirt_retry(on_failure=(False, "❌ Libvirt connection failed"))
     def stop_vm(self, vm_name) -> Tuple[bool, Union[str]]:
         """Gracefully shuts down a virtual machine (ACPI shutdown)."""
-        conn = self._reconnect()
-        if not conn: 
-            return False, "❌ Libvirt connection failed"
+        conn = self.conn
         
         try:
             dom = conn.lookupByName(vm_name)
             dom.shutdown()
+            self._mark_vm_dirty(vm_name)
             logger.info(f"Virtual machine '{vm_name}' is shutting down.")
             return True, f"✅ Virtual machine '{vm_name}' is shutting down."
         except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             return False, f"❌ Failed to shut down virtual machine '{vm_name}': {e}"
 
+    @_with_libvirt_retry(on_failure=(False, "❌ Libvirt connection failed"))
     def destroy_vm(self, vm_name) -> Tuple[bool, Union[str]]:
         """Forcefully powers off a virtual machine."""
-        conn = self._reconnect()
-        if not conn: 
-            return False, "Libvirt connection failed"
+        conn = self.conn
 
         try:
             dom = conn.lookupByName(vm_name)
             dom.destroy()
+            self._mark_vm_dirty(vm_name)
             logger.info(f"Virtual machine '{vm_name}' forcefully powered off successfully.")
             return True, f"✅ Virtual machine '{vm_name}' forcefully powered off successfully."
         except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             return False, f"❌ Failed to forcefully power off virtual machine '{vm_name}': {e}"
 
+    @_with_libvirt_retry(on_failure=(False, "❌ Libvirt connection failed"))
     def delete_vm(self, vm_name) -> Tuple[bool, Union[str]]:
         """Deletes a virtual machine (including its disk file)."""
-        conn = self._reconnect()
-        if not conn: 
-            return False, "Libvirt connection failed"
+        conn = self.conn
         try:
             dom = conn.lookupByName(vm_name)
             if dom.isActive():
                 dom.destroy() # First, forcefully power off
                 logger.info(f"Virtual machine '{vm_name}' has been forcefully powered off.")
             
-            # Get disk path
-            disk_path = self._get_disk_path(dom.XMLDesc(0))
+            # Get disk volume: VMs created by create_vm_from_template always use <pool>/<vm_name>.qcow2,
+            # so the domain XML is only needed for other layouts. Resolved before undefine so a
+            # missing volume does not leave an undefined VM with its disk behind.
+            try:
+                pool = self._get_storage_pool(conn)
+            except libvirt.libvirtError:
+                pool = None
+            disk_vol = None
+            disk_path = "Unknown"
+            if pool is not None:
+                try:
+                    disk_vol = self._lookup_volume(pool, pool.storageVolLookupByName, f"{vm_name}.qcow2")
+                    disk_path = disk_vol.path()
+                except libvirt.libvirtError:
+                    pass
+            if disk_vol is None:
+                disk_path = self._extract_disk_path(self._domain_xml(dom))
+                if disk_path != "Unknown":
+                    try:
+                        disk_vol = (self._lookup_volume(pool, conn.storageVolLookupByPath, disk_path)
+                                    if pool is not None else conn.storageVolLookupByPath(disk_path))
+                    except libvirt.libvirtError as e:
+                        if _is_connection_error(e):
+                            raise
+                        logger.warning(f"Disk file '{disk_path}' of '{vm_name}' is not a volume in any storage pool, leaving it in place.")
             
             dom.undefine() # Undefine the virtual machine
+            self._invalidate_domain_xml(dom)
+            self._mark_vm_dirty(vm_name)
             logger.info(f"Virtual machine '{vm_name}' has been undefined.")
 
-            # Delete disk file
-            if disk_path and os.path.exists(disk_path):
-                success, msg = self._run_system_command_sudo('rm_force', path=disk_path)
-                if not success:
-                    return False, f"❌ Failed to delete disk file '{disk_path}': {msg}"
+            # Delete disk volume
+            if disk_vol is not None:
+                try:
+                    disk_vol.delete(0)
+                except libvirt.libvirtError as e:
+                    return False, f"❌ Failed to delete disk file '{disk_path}': {e}"
                 logger.info(f"Virtual machine disk file '{disk_path}' deleted.")
             
             return True, f"✅ Virtual machine '{vm_name}' deleted successfully."
         except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             return False, f"❌ Failed to delete virtual machine '{vm_name}': {e}"
         except Exception as e:
             return False, f"❌ An unexpected error occurred while deleting virtual machine '{vm_name}': {e}"
 
+    @_with_libvirt_retry()
     def get_vm_vnc_port(self, vm_name):
         """Gets the VNC port of a virtual machine."""
-        conn = self._reconnect()
-        if not conn: 
-            return None
+        conn = self.conn
         try:
             dom = conn.lookupByName(vm_name)
-            return self._get_vnc_port(dom.XMLDesc(0))
-        except libvirt.libvirtError:
+            return self._extract_vnc_port(self._domain_xml(dom))
+        except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             return None # VM does not exist or is not running
     
+    @_with_libvirt_retry()
+    def get_vm_details(self, vm_name) -> Union[Dict, None]:
+        """Gets the detailed status of a single virtual machine."""
+        conn = self.conn
+        try:
+            dom = conn.lookupByName(vm_name)
+            return self._get_domain_details(dom)
+        except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
+            return None # VM does not exist
+    
+    @_with_libvirt_retry()
     def get_domain_by_name(self, vm_name):
         """
         Looks up a libvirt domain by its name.
@@ -520,63 +1011,13 @@ class LibvirtManager:
         Returns:
             libvirt.virDomain or None: The domain object if found, otherwise None.
         """
-        conn = self._reconnect()
-        if not conn:
-            logger.error(f"Cannot lookup VM '{vm_name}': Libvirt connection failed.")
-            return None
+        conn = self.conn
         try:
             dom = conn.lookupByName(vm_name)
             return dom
         except libvirt.libvirtError as e:
+            if _is_connection_error(e):
+                raise # handled by _with_libvirt_retry
             # Typically means domain not found, but could be other libvirt errors
             logger.warning(f"Failed to lookup domain '{vm_name}': {e}")
             return None
-        
-    def delete_vm_file(vm_name: str):
-        """
-        自动关闭、注销并删除虚拟机及其.qcow2磁盘文件
-        :param vm_name: 虚拟机名称
-        """
-        def run(cmd):
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-            return result.returncode, result.stdout.strip(), result.stderr.strip()
-
-        logger.info(f"🔍 尝试删除虚拟机: {vm_name}")
-
-        # # Step 1: 尝试关闭虚拟机
-        # print("➡️ 正在尝试关闭虚拟机...")
-        # run(f"sudo virsh destroy {vm_name}")  # destroy 即便关闭失败也不会阻止后续步骤
-
-        # Step 2: 获取磁盘路径
-        logger.info("➡️ 获取磁盘路径...")
-        ret, output, err = run(f"sudo virsh domblklist {vm_name}")
-        if ret != 0:
-            logger.error(f"❌ 获取磁盘路径失败: {err}")
-            return
-
-        disk_paths = []
-        for line in output.splitlines():
-            if line.startswith("vda") or line.startswith("hda") or line.startswith("sda"):
-                parts = line.split()
-                if len(parts) == 2:
-                    disk_paths.append(parts[1])
-
-        # Step 3: 注销虚拟机
-        logger.info("➡️ 注销虚拟机定义...")
-        ret, _, err = run(f"sudo virsh undefine {vm_name}")
-        if ret != 0:
-            logger.error(f"❌ 注销失败: {err}")
-            return
-
-        # Step 4: 删除磁盘文件
-        for disk_path in disk_paths:
-            if os.path.exists(disk_path):
-                logger.info(f"🗑️ 删除磁盘文件: {disk_path}")
-                try:
-                    os.remove(disk_path)
-                except Exception as e:
-                    logger.error(f"❌ 删除失败: {e}")
-            else:
-                logger.info(f"⚠️ 磁盘文件不存在: {disk_path}")
-
-        logger.info(f"✅ 虚拟机 {vm_name} 删除完成。")
\ No newline at end of file